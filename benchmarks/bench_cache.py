@@ -0,0 +1,100 @@
+"""
+bench_cache.py : Cache throughput with several processes writing at once
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Run from the agent directory (signed settings are required):
+    python benchmarks/bench_cache.py [processes] [seconds] [shards]
+"""
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import diskcache
+
+from epc.common.cache import Cache, ShardedCache
+
+KEYS = 2000
+TAGS = ['importer', 'scheduler']
+WRITE_RATIO = 0.5
+PAYLOAD_SIZE = 4096
+
+
+def hammer(args):
+    """Mix writes and reads on random keys until the deadline, as workers starting at once do"""
+    mode, directory, shards, seconds, seed = args
+    cache = ShardedCache(directory, shards) if mode == 'sharded' else Cache(directory)
+    cache.memory.ttl = 0  # Measure the databases
+    rng = random.Random(seed)
+    payload = os.urandom(PAYLOAD_SIZE)
+    latencies = []
+    reads = failed = errors = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        key = 'key_{}'.format(rng.randrange(KEYS))
+        start = time.perf_counter()
+        try:
+            if rng.random() < WRITE_RATIO:
+                if not cache.set(key, payload, tag=rng.choice(TAGS)):
+                    failed += 1
+                latencies.append(time.perf_counter() - start)
+            else:
+                cache.get(key)
+                reads += 1
+        except (diskcache.Timeout, sqlite3.OperationalError):
+            errors += 1
+    return latencies, reads, failed, errors
+
+
+def run(mode: str, processes: int, seconds: int, shards: int) -> None:
+    directory = tempfile.mkdtemp(prefix='bench-cache-')
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes) as pool:
+        results = pool.map(hammer, [(mode, directory, shards, seconds, x) for x in range(processes)])
+
+    latencies = sorted(x for result in results for x in result[0])
+    reads = sum(x[1] for x in results)
+    failed = sum(x[2] for x in results)
+    errors = sum(x[3] for x in results)
+    cache = ShardedCache(directory, shards) if mode == 'sharded' else Cache(directory)
+    print("{:8}: {:8.0f} writes/s {:8.0f} reads/s, write p50 {:7.2f} ms p99 {:7.2f} ms max {:7.2f} ms, "
+          "{} failed writes, {} errors".format(
+              mode, len(latencies) / seconds, reads / seconds,
+              latencies[len(latencies) // 2] * 1e3 if latencies else 0,
+              latencies[len(latencies) * 99 // 100] * 1e3 if latencies else 0,
+              latencies[-1] * 1e3 if latencies else 0,
+              failed, errors))
+    print("{:8}  tags {}, keys by tag {}".format(
+        '', sorted(cache.list_tags()), {k: v['keys'] for k, v in sorted(cache.tag_usage().items())}))
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    shards = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    print("{} processes, {} s, {} shards".format(processes, seconds, shards))
+    run('single', processes, seconds, shards)
+    run('sharded', processes, seconds, shards)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+bench_crypto.py : Throughput of the crypto backends
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Run from the agent directory:
+    python benchmarks/bench_crypto.py [size_in_kib] [rounds]
+"""
+import os
+import sys
+import timeit
+
+from epc.common.crypto import (CIPHER_NAMES, SIGNATURE_ED25519, available_backends, decrypt_payload, encrypt_payload,
+                               get_backend, verify_signature)
+
+
+def make_signature(data: bytes):
+    """Create a 4096 bits RSA-PSS SHA512 signature as the server does, returns (pubkey, signature)"""
+    if 'pycrypto' in available_backends():
+        from Crypto.Hash import SHA512
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import PKCS1_PSS
+        key = RSA.generate(4096)
+        return key.publickey().exportKey().decode('ascii'), PKCS1_PSS.new(key).sign(SHA512.new(data))
+
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+    key = rsa.generate_private_key(65537, 4096, default_backend())
+    pubkey = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                           serialization.PublicFormat.SubjectPublicKeyInfo)
+    signature = key.sign(data, padding.PSS(mgf=padding.MGF1(hashes.SHA512()), salt_length=64), hashes.SHA512())
+    return pubkey.decode('ascii'), signature
+
+
+def make_ed25519_signature(data: bytes):
+    """Create a zero padded Ed25519 signature, returns (pubkey, signature) or (None, None) when unsupported"""
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+        key = Ed25519PrivateKey.generate()
+        pubkey = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                               serialization.PublicFormat.SubjectPublicKeyInfo)
+        return pubkey.decode('ascii'), key.sign(data).ljust(512, b'\0')
+    except ImportError:
+        pass
+    try:
+        from Crypto.PublicKey import ECC
+        from Crypto.Signature import eddsa
+        key = ECC.generate(curve='ed25519')
+        return key.public_key().export_key(format='PEM'), eddsa.new(key, 'rfc8032').sign(data).ljust(512, b'\0')
+    except ImportError:
+        return None, None
+
+
+def main():
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 1024) * 1024
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    key = os.urandom(32)
+    plain = os.urandom(size)
+    small = plain[:4096]
+    pubkey, signature = make_signature(small)
+    ed_pubkey, ed_signature = make_ed25519_signature(small)
+
+    for name in available_backends():
+        backend = get_backend(name)
+        print("{} backend".format(name))
+        for mode, mode_name in sorted(CIPHER_NAMES.items()):
+            try:
+                payload = encrypt_payload(mode, key, plain, backend)
+            except ValueError as exc:
+                print("  {:<8}: unavailable ({})".format(mode_name, exc))
+                continue
+            assert decrypt_payload(mode, key, payload, backend) == plain
+            elapsed = timeit.timeit(lambda: decrypt_payload(mode, key, payload, backend), number=rounds)
+            print("  {:<8}: {:8.1f} MiB/s".format(mode_name, size * rounds / elapsed / (1024 * 1024)))
+
+        assert verify_signature(pubkey, [small], signature, backend=backend)
+        verify_rounds = rounds * 20
+        elapsed = timeit.timeit(lambda: verify_signature(pubkey, [small], signature, backend=backend),
+                                number=verify_rounds)
+        print("  RSA-PSS : {:8.1f} us/verify".format(elapsed * 1e6 / verify_rounds))
+
+        if ed_pubkey is None or not backend.has_ed25519():
+            print("  Ed25519 : unavailable")
+            continue
+        assert verify_signature(ed_pubkey, [small], ed_signature, SIGNATURE_ED25519, backend=backend)
+        elapsed = timeit.timeit(
+            lambda: verify_signature(ed_pubkey, [small], ed_signature, SIGNATURE_ED25519, backend=backend),
+            number=verify_rounds)
+        print("  Ed25519 : {:8.1f} us/verify".format(elapsed * 1e6 / verify_rounds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+bench_finder.py : Import overhead of the network importer finder
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+
+Run from the agent directory (signed settings and a cached manifest are required):
+    python benchmarks/bench_finder.py [rounds]
+"""
+import importlib.util
+import sys
+import timeit
+
+from epc.common.importer import EPCLoader, EPCMetaFinder
+
+# Standard library modules looked up by the benchmark, none of them is in the manifest
+NAMES = [
+    'json', 'logging.handlers', 'xml.dom.minidom', 'email.mime.text', 'http.cookiejar',
+    'concurrent.futures.process', 'sqlite3.dump', 'urllib.robotparser', 'wsgiref.simple_server',
+    'ctypes.util', 'distutils.version', 'unittest.mock', 'asyncio.subprocess', 'csv', 'tarfile',
+]
+
+
+def find_all():
+    """Look up every name through sys.meta_path, as the import system does"""
+    for name in NAMES:
+        importlib.util.find_spec(name)
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    finder = EPCMetaFinder(EPCLoader())
+
+    find_all()  # Import the parent packages and warm the path importer caches
+    baseline = timeit.timeit(find_all, number=rounds)
+    sys.meta_path.insert(0, finder)
+    try:
+        with_finder = timeit.timeit(find_all, number=rounds)
+    finally:
+        sys.meta_path.remove(finder)
+
+    lookups = rounds * len(NAMES)
+    direct = timeit.timeit(lambda: [finder.find_spec(x, None) for x in NAMES], number=rounds)
+    print("meta_path lookups        : {}".format(lookups))
+    print("without EPCMetaFinder    : {:.2f} us/lookup".format(baseline * 1e6 / lookups))
+    print("with EPCMetaFinder       : {:.2f} us/lookup".format(with_finder * 1e6 / lookups))
+    print("EPCMetaFinder.find_spec  : {:.3f} us/miss".format(direct * 1e6 / lookups))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+bundle.py : Offline code bundle
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import mmap
+import os
+import struct
+import tempfile
+from typing import Optional
+
+import epc.common.settings as settings
+from epc.common.manifest import MANIFEST_MAGIC, NAME_HASH_SIZE
+
+# Bundle: header | signed manifest | entries sorted by name_hash | encrypted modules
+BUNDLE_MAGIC = b'EPCBNDL1'
+BUNDLE_HEADER = struct.Struct('<8sII')  # magic, manifest size, count
+BUNDLE_ENTRY = struct.Struct('<32s32sQI')  # name_hash, code_hash, offset, size
+
+_bundle = None
+
+
+def get_bundle_path() -> Optional[str]:
+    """Get the path of the offline bundle, None if there is none"""
+    return settings.Config().get('IMPORTER_BUNDLE')
+
+
+def get_bundle() -> Optional['Bundle']:
+    """Get the offline bundle of this process, None if there is no usable bundle"""
+    global _bundle
+    if _bundle is None:
+        filename = get_bundle_path()
+        _bundle = (Bundle.open(filename) if filename else None) or False
+    return _bundle or None
+
+
+def write_bundle(filename: str, manifest: bytes, modules) -> None:
+    """
+    Write a bundle from a signed manifest and an iterable of (name_hash, code_hash, encrypted data)
+
+    Raises: OSError
+    """
+    modules = sorted(modules, key=lambda x: x[0])
+    offset = BUNDLE_HEADER.size + len(manifest) + len(modules) * BUNDLE_ENTRY.size
+    entries = []
+    for name_hash, code_hash, data in modules:
+        entries.append(BUNDLE_ENTRY.pack(name_hash, code_hash, offset, len(data)))
+        offset += len(data)
+
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(fd, 'wb') as ofile:
+            ofile.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, len(manifest), len(entries)))
+            ofile.write(manifest)
+            ofile.write(b''.join(entries))
+            for _, _, data in modules:
+                ofile.write(data)
+        os.replace(tmpname, filename)
+    except OSError:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        raise
+
+
+class Bundle(object):
+    """
+    Read-only view over a memory-mapped bundle.
+    Nothing in the bundle is trusted: the manifest is verified as any other one
+    and the modules are checked against the code_hash of the manifest in use.
+    """
+
+    def __init__(self, mapped: mmap.mmap, manifest_size: int, count: int):
+        self.__map = mapped
+        self.__view = memoryview(mapped)
+        self.__manifest_size = manifest_size
+        self.__entries = BUNDLE_HEADER.size + manifest_size
+        self.__count = count
+
+    @classmethod
+    def open(cls, filename: str) -> Optional['Bundle']:
+        """Map a bundle, None if it is missing or malformed"""
+        try:
+            with open(filename, 'rb') as ifile:
+                mapped = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, manifest_size, count = BUNDLE_HEADER.unpack_from(mapped)
+        except struct.error:
+            mapped.close()
+            return None
+        if magic != BUNDLE_MAGIC or \
+                len(mapped) < BUNDLE_HEADER.size + manifest_size + count * BUNDLE_ENTRY.size or \
+                mapped[BUNDLE_HEADER.size:BUNDLE_HEADER.size + len(MANIFEST_MAGIC)] != MANIFEST_MAGIC:
+            mapped.close()
+            return None
+        return cls(mapped, manifest_size, count)
+
+    @property
+    def manifest(self) -> bytes:
+        """The signed manifest the bundle was made from"""
+        return self.__map[BUNDLE_HEADER.size:BUNDLE_HEADER.size + self.__manifest_size]
+
+    def __find(self, name_hash: bytes) -> int:
+        low, high = 0, self.__count
+        while low < high:
+            mid = (low + high) // 2
+            offset = self.__entries + mid * BUNDLE_ENTRY.size
+            current = self.__map[offset:offset + NAME_HASH_SIZE]
+            if current < name_hash:
+                low = mid + 1
+            elif current > name_hash:
+                high = mid
+            else:
+                return offset
+        return -1
+
+    def get(self, name_hash: bytes, code_hash: bytes) -> Optional[memoryview]:
+        """Get the encrypted data of a module, None if the bundle does not have this version of the module"""
+        offset = self.__find(name_hash)
+        if offset < 0:
+            return None
+        _, bundled_hash, start, size = BUNDLE_ENTRY.unpack_from(self.__map, offset)
+        if bundled_hash != code_hash or start + size > len(self.__map):
+            return None
+        return self.__view[start:start + size]
+
+    def __len__(self) -> int:
+        return self.__count
@@ -19,7 +19,16 @@ You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import logging
 import os
+import pickle
+import sqlite3
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import List
 
 import epc.common.settings as settings
@@ -32,34 +41,504 @@ CACHE_SETTINGS = dict(
     tag_index=True
 )
 
+MEMORY_CACHE_ENTRIES = 1024
+MEMORY_CACHE_SIZE = 8 * 1024 * 1024
+MEMORY_CACHE_TTL = 30  # Bounds how long a value written by another process can be missed
 
-class Cache(diskcache.Cache, metaclass=Singleton):
-    """Cache Manager"""
+SHARDS = 8
+SHARD_TIMEOUT = 0.100  # Seconds waiting for the lock of a shard
 
-    def __init__(self):
-        os.makedirs(settings.Config().CACHE_DIR, exist_ok=True)
-        super(Cache, self).__init__(
-            settings.Config().CACHE_DIR,
-            **CACHE_SETTINGS)
+BATCH_SIZE = 500  # Keys per statement, below the SQLite limit of bound parameters
+
+# Upper bounds of the latency histogram buckets in microseconds, the last bucket is unbounded
+LATENCY_BUCKETS = (10, 100, 1000, 10000, 100000)
+NO_TAG = '-'  # Operations on untagged keys, or missing keys read without a metrics_tag
+
+# Returned as is from the memory layer, any other value is stored pickled and unpickled on each hit
+_IMMUTABLE_TYPES = (bytes, str, int, float, bool, type(None))
+
+_MISSING = object()
+
+
+class MemoryCache(object):
+    """
+    In-process LRU in front of the disk cache, bounded by entries and size.
+    Entries are dropped when they expire, and at the latest after a TTL since the other processes
+    of the host share the disk cache.
+    """
+
+    def __init__(self, max_entries: int, max_size: int, ttl: int, disabled_tags=()):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disabled_tags = set(disabled_tags)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()  # key -> (value, pickled, size, expire_time, tag, deadline)
+        self.__lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_size > 0 and self.ttl > 0
+
+    def get(self, key):
+        """Get (value, expire_time, tag), _MISSING when the key is not cached or is stale"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return _MISSING
+            if entry[5] <= time.time():
+                self.__drop(key)
+                self.misses += 1
+                return _MISSING
+            self.__entries.move_to_end(key)
+            self.hits += 1
+        value = pickle.loads(entry[0]) if entry[1] else entry[0]
+        return value, entry[3], entry[4]
+
+    def set(self, key, value, expire_time, tag) -> None:
+        """Cache a value just read from or written to the disk cache"""
+        if not self.enabled or tag in self.disabled_tags:
+            self.discard(key)
+            return
+        pickled = not isinstance(value, _IMMUTABLE_TYPES)
+        if pickled:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = len(value) if isinstance(value, (bytes, str)) else 8
+        if size > self.max_size // 16:
+            # Large values (code blobs) are read from the disk cache only
+            self.discard(key)
+            return
+        deadline = time.time() + self.ttl
+        if expire_time is not None:
+            deadline = min(deadline, expire_time)
+        with self.__lock:
+            self.__drop(key)
+            self.__entries[key] = (value, pickled, size, expire_time, tag, deadline)
+            self.size += size
+            while len(self.__entries) > self.max_entries or self.size > self.max_size:
+                self.__drop(next(iter(self.__entries)))
+
+    def touch(self, key, expire_time) -> None:
+        """Update the expiration time of a cached value"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                deadline = time.time() + self.ttl
+                if expire_time is not None:
+                    deadline = min(deadline, expire_time)
+                self.__entries[key] = entry[:3] + (expire_time, entry[4], deadline)
+
+    def discard(self, key) -> None:
+        """Remove a key"""
+        with self.__lock:
+            self.__drop(key)
+
+    def evict(self, tag) -> None:
+        """Remove the keys of a tag"""
+        with self.__lock:
+            for key in [k for k, v in self.__entries.items() if v[4] == tag]:
+                self.__drop(key)
+
+    def clear(self) -> None:
+        """Remove all the keys"""
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+
+    def __drop(self, key) -> None:
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def stats(self) -> dict:
+        """Get the memory layer counters"""
+        return dict(
+            entries=len(self.__entries),
+            size=self.size,
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses
+        )
 
-    def set(self, key, value, expire=None, read=False, tag=None):
-        """Add a configurable default expiration"""
+
+class CacheMetrics(object):
+    """Counters and latency histograms of the cache operations, by tag"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.__ops = dict()  # (tag, operation) -> [calls, keys, hits, total_us, buckets...]
+        self.__lock = threading.Lock()
+        self.__last_log = time.time()
+
+    @staticmethod
+    def start() -> float:
+        return time.perf_counter()
+
+    def record(self, operation: str, tag, start: float, keys: int = 1, hits: int = 0) -> None:
+        """Record an operation started at start (see start()) on keys of tag"""
+        if not self.enabled:
+            return
+        elapsed = (time.perf_counter() - start) * 1e6
+        op_key = (tag or NO_TAG, operation)
+        with self.__lock:
+            entry = self.__ops.get(op_key)
+            if entry is None:
+                entry = self.__ops[op_key] = [0, 0, 0, 0.0] + [0] * (len(LATENCY_BUCKETS) + 1)
+            entry[0] += 1
+            entry[1] += keys
+            entry[2] += hits
+            entry[3] += elapsed
+            entry[4 + bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    def snapshot(self) -> dict:
+        """Get the counters, as tag -> operation -> counters"""
+        labels = ['<={}us'.format(x) for x in LATENCY_BUCKETS] + ['>{}us'.format(LATENCY_BUCKETS[-1])]
+        with self.__lock:
+            ops = {k: list(v) for k, v in self.__ops.items()}
+        result = dict()
+        for (tag, operation), entry in sorted(ops.items()):
+            result.setdefault(tag, dict())[operation] = dict(
+                calls=entry[0],
+                keys=entry[1],
+                hits=entry[2],
+                mean_us=entry[3] / entry[0],
+                latency=OrderedDict(zip(labels, entry[4:]))
+            )
+        return result
+
+    def reset(self) -> None:
+        """Reset the counters"""
+        with self.__lock:
+            self.__ops.clear()
+
+    def log_due(self, interval: int) -> bool:
+        """Tell if the counters have not been logged for interval seconds, and account for logging them now"""
+        now = time.time()
+        if not self.enabled or not interval or now - self.__last_log < interval:
+            return False
+        self.__last_log = now
+        return True
+
+
+class CacheLayer(metaclass=ABCMeta):
+    """
+    Memory layer, metrics, batch operations and tag queries on top of a diskcache storage,
+    either a single database (Cache) or several shards (ShardedCache)
+    """
+
+    def _init_layer(self):
+        self.memory = MemoryCache(
+            settings.Config().get('CACHE_MEMORY_ENTRIES', MEMORY_CACHE_ENTRIES),
+            settings.Config().get('CACHE_MEMORY_SIZE', MEMORY_CACHE_SIZE),
+            settings.Config().get('CACHE_MEMORY_TTL', MEMORY_CACHE_TTL),
+            settings.Config().get('CACHE_MEMORY_DISABLED_TAGS', ()))
+        self.metrics = CacheMetrics(settings.Config().get('CACHE_METRICS', True))
+
+    def set(self, key, value, expire=None, read=False, tag=None, retry=False):
+        """Add a configurable default expiration, values are written through the memory layer"""
+        start = self.metrics.start()
         if not expire:
             expire = CACHE_SETTINGS.get('default_expiration')
-        return super(Cache, self).set(key, value, expire, read, tag)
+        ret = super(CacheLayer, self).set(key, value, expire, read, tag, retry)
+        if ret and not read:
+            self.memory.set(key, value, time.time() + expire, tag)
+        else:
+            self.memory.discard(key)  # The value was a file, or a locked shard kept the previous one
+        self.metrics.record('set', tag, start)
+        return ret
+
+    def get(self, key, default=None, read=False, expire_time=False, tag=False, retry=False, metrics_tag=None):
+        """
+        Get a value from the memory layer, or from the disk cache.
+        The read is accounted to metrics_tag, by default to the tag of the value found: misses are then untagged.
+        """
+        start = self.metrics.start()
+        if read:
+            entry = super(CacheLayer, self).get(key, _MISSING, read, True, True, retry)
+            if entry is _MISSING:
+                entry = (_MISSING, None, None)
+        else:
+            entry = self.memory.get(key)
+            if entry is _MISSING:
+                entry = super(CacheLayer, self).get(key, _MISSING, False, True, True, retry)
+                if entry is _MISSING:
+                    entry = (_MISSING, None, None)  # Timeout of a shard
+                elif entry[0] is not _MISSING:
+                    self.memory.set(key, *entry)
+        hit = entry[0] is not _MISSING
+        self.metrics.record('get', metrics_tag or entry[2], start, hits=int(hit))
+        if not hit:
+            entry = (default, None, None)
+        if expire_time and tag:
+            return entry
+        if expire_time:
+            return entry[:2]
+        if tag:
+            return entry[0], entry[2]
+        return entry[0]
+
+    def __contains__(self, key):
+        return self.memory.get(key) is not _MISSING or super(CacheLayer, self).__contains__(key)
+
+    def touch(self, key, expire=None, retry=False):
+        ret = super(CacheLayer, self).touch(key, expire, retry)
+        if ret:
+            self.memory.touch(key, time.time() + expire if expire else None)
+        else:
+            self.memory.discard(key)
+        return ret
+
+    def delete(self, key, retry=False, metrics_tag=None):
+        start = self.metrics.start()
+        ret = super(CacheLayer, self).delete(key, retry)
+        self.memory.discard(key)
+        self.metrics.record('delete', metrics_tag, start, hits=int(ret))
+        return ret
+
+    def __delitem__(self, key, *args, **kwargs):
+        ret = super(CacheLayer, self).__delitem__(key, *args, **kwargs)
+        self.memory.discard(key)
+        return ret
+
+    def pop(self, key, default=None, expire_time=False, tag=False, retry=False):
+        ret = super(CacheLayer, self).pop(key, default, expire_time, tag, retry)
+        self.memory.discard(key)
+        return ret
+
+    def add(self, key, value, expire=None, read=False, tag=None, retry=False):
+        ret = super(CacheLayer, self).add(key, value, expire, read, tag, retry)
+        self.memory.discard(key)
+        return ret
+
+    def incr(self, key, delta=1, default=0, retry=False):
+        ret = super(CacheLayer, self).incr(key, delta, default, retry)
+        self.memory.discard(key)
+        return ret
+
+    def evict(self, tag, retry=False):
+        """Remove the keys of a tag, from both layers"""
+        start = self.metrics.start()
+        ret = super(CacheLayer, self).evict(tag, retry)
+        self.memory.evict(tag)
+        self.metrics.record('evict', tag, start, keys=ret)
+        return ret
+
+    def clear(self, retry=False):
+        ret = super(CacheLayer, self).clear(retry)
+        self.memory.clear()
+        return ret
+
+    @contextmanager
+    def transact(self, *args, **kwargs):
+        """The memory layer is dropped when the transaction is rolled back"""
+        try:
+            with super(CacheLayer, self).transact(*args, **kwargs):
+                yield
+        except BaseException:
+            self.memory.clear()
+            raise
+
+    @contextmanager
+    def _transact_shard(self, shard: diskcache.Cache):
+        """Transaction on the shard of some keys only, the memory layer is dropped when it is rolled back"""
+        try:
+            with shard.transact(retry=True):
+                yield
+        except BaseException:
+            self.memory.clear()
+            raise
+
+    @abstractmethod
+    def _databases(self):
+        """Get the diskcache.Cache databases"""
+        ...
+
+    @abstractmethod
+    def _database(self, key) -> diskcache.Cache:
+        """Get the diskcache.Cache database of a key"""
+        ...
+
+    def _group_by_shard(self, items, key=lambda x: x):
+        groups = OrderedDict()  # shard -> items
+        for item in items:
+            groups.setdefault(self._database(key(item)), []).append(item)
+        return groups.items()
+
+    def get_many(self, keys, metrics_tag=None) -> dict:
+        """
+        Get several values at once, the ones missing from the memory layer are read with a single statement.
+        The batch is accounted to metrics_tag, by default to the tag shared by all the keys found.
+        Returns a dict of the keys found.
+        """
+        start = self.metrics.start()
+        values = dict()
+        tags = set()
+        missing = []
+        for key in keys:
+            entry = self.memory.get(key)
+            if entry is _MISSING:
+                missing.append(key)
+            else:
+                values[key] = entry[0]
+                tags.add(entry[2])
+        requested = len(values) + len(missing)
+
+        # The eviction policy does not update the rows on get, a plain select is enough
+        select = (
+            'SELECT key, raw, expire_time, tag, mode, filename, value FROM Cache'
+            ' WHERE key IN ({}) AND (expire_time IS NULL OR expire_time > ?)'
+        )
+        for shard, shard_keys in self._group_by_shard(missing):
+            pending = {shard.disk.put(x): x for x in shard_keys}  # (db_key, raw) -> key
+            db_keys = list(pending)
+            for i in range(0, len(db_keys), BATCH_SIZE):
+                chunk = db_keys[i:i + BATCH_SIZE]
+                try:
+                    rows = shard._sql(select.format(','.join('?' * len(chunk))),
+                                      [x[0] for x in chunk] + [time.time()]).fetchall()
+                except sqlite3.OperationalError:
+                    continue  # Locked, read as misses
+                for db_key, raw, db_expire_time, db_tag, mode, filename, db_value in rows:
+                    key = pending.get((db_key, raw))
+                    if key is None:
+                        continue
+                    try:
+                        value = shard.disk.fetch(mode, filename, db_value, False)
+                    except IOError:
+                        continue  # Deleted since the select
+                    values[key] = value
+                    tags.add(db_tag)
+                    self.memory.set(key, value, db_expire_time, db_tag)
+        if metrics_tag is None and len(tags) == 1:
+            metrics_tag = tags.pop()
+        self.metrics.record('get_many', metrics_tag, start,
+                            keys=requested, hits=len(values))
+        return values
+
+    def set_many(self, items, expire=None, tag=None) -> None:
+        """Set several values in a single transaction per shard"""
+        items = items.items() if isinstance(items, dict) else items
+        for shard, shard_items in self._group_by_shard(items, key=lambda x: x[0]):
+            with self._transact_shard(shard):
+                for key, value in shard_items:
+                    self.set(key, value, expire=expire, tag=tag)
+
+    def delete_many(self, keys, metrics_tag=None) -> int:
+        """Delete several keys in a single transaction per shard, returns the number of keys deleted"""
+        count = 0
+        for shard, shard_keys in self._group_by_shard(keys):
+            with self._transact_shard(shard):
+                count += sum(1 for key in shard_keys if self.delete(key, metrics_tag=metrics_tag))
+        return count
 
     def get_tag(self, tag: str) -> List[str]:
         """Get all keys for a specific tag"""
         select = (
             'SELECT key FROM Cache WHERE tag = ?'
         )
-        rows = self._sql(select, (tag,)).fetchall()
-        return [x[0] for x in rows] if rows else []
+        return [x[0] for shard in self._databases() for x in shard._sql(select, (tag,)).fetchall()]
 
     def list_tags(self) -> List[str]:
         """Utility function to list all tags in the cache"""
         select = (
             'SELECT DISTINCT tag FROM Cache'
         )
-        rows = self._sql(select).fetchall()
-        return [x[0] for x in rows] if rows else []
+        tags = []
+        for shard in self._databases():
+            tags.extend(x[0] for x in shard._sql(select).fetchall() if x[0] not in tags)
+        return tags
+
+    def tag_usage(self) -> dict:
+        """Get the number of keys and the bytes stored by tag"""
+        select = (
+            'SELECT tag, COUNT(*), SUM(size + IFNULL(LENGTH(value), 0)) FROM Cache GROUP BY tag'
+        )
+        usage = dict()
+        for shard in self._databases():
+            for tag, keys, size in shard._sql(select).fetchall():
+                counters = usage.setdefault(tag or NO_TAG, dict(keys=0, size=0))
+                counters['keys'] += keys
+                counters['size'] += size or 0
+        return usage
+
+    def report(self) -> dict:
+        """Get the operation counters, the memory layer counters and the usage by tag"""
+        return dict(
+            operations=self.metrics.snapshot(),
+            memory=self.memory.stats(),
+            usage=self.tag_usage(),
+            volume=self.volume()
+        )
+
+    def log_report(self, level: int = logging.INFO) -> None:
+        """Dump the report to the logs"""
+        report = self.report()
+        logging.log(level, "Cache: %d bytes on disk, memory layer %d entries %d bytes (%d hits, %d misses)",
+                    report['volume'], report['memory']['entries'], report['memory']['size'],
+                    report['memory']['hits'], report['memory']['misses'])
+        for tag, usage in sorted(report['usage'].items()):
+            logging.log(level, "Cache [%s]: %d keys, %d bytes", tag, usage['keys'], usage['size'])
+        for tag, operations in sorted(report['operations'].items()):
+            for operation, counters in sorted(operations.items()):
+                logging.log(level, "Cache [%s] %s: %d calls, %d keys, %d hits, %.1f us mean, latency %s",
+                            tag, operation, counters['calls'], counters['keys'], counters['hits'],
+                            counters['mean_us'], ' '.join('{}:{}'.format(k, v) for k, v in counters['latency'].items()))
+
+
+class CacheType(Singleton, ABCMeta):
+    """
+    Cache() is the shared cache of CACHE_DIR, the sharded one when CACHE_SHARDS is above 1.
+    Cache(directory) and ShardedCache(directory, shards) are new instances, outside the singleton.
+    """
+
+    def __call__(cls, *args, **kwargs):
+        if args or kwargs:
+            return type.__call__(cls, *args, **kwargs)
+        if cls is Cache and settings.Config().get('CACHE_SHARDS', 0) > 1:
+            cls = ShardedCache
+        return super(CacheType, cls).__call__()
+
+
+class Cache(CacheLayer, diskcache.Cache, metaclass=CacheType):
+    """Cache Manager"""
+
+    def __init__(self, directory: str = None):
+        directory = directory or settings.Config().CACHE_DIR
+        os.makedirs(directory, exist_ok=True)
+        super(Cache, self).__init__(
+            directory,
+            **CACHE_SETTINGS)
+        self._init_layer()
+
+    def _databases(self):
+        return [self]
+
+    def _database(self, key) -> diskcache.Cache:
+        return self
+
+
+class ShardedCache(CacheLayer, diskcache.FanoutCache, metaclass=CacheType):
+    """
+    Cache Manager spreading the keys over several databases, so that the service and the workers
+    do not all wait for the lock of a single database when writing.
+    Operations timing out on a locked shard are read as misses and failed writes, as in diskcache.FanoutCache.
+    """
+
+    def __init__(self, directory: str = None, shards: int = None):
+        directory = directory or os.path.join(settings.Config().CACHE_DIR, 'shards')
+        os.makedirs(directory, exist_ok=True)
+        super(ShardedCache, self).__init__(
+            directory,
+            shards=shards or settings.Config().get('CACHE_SHARDS', SHARDS),
+            timeout=settings.Config().get('CACHE_SHARD_TIMEOUT', SHARD_TIMEOUT),
+            **CACHE_SETTINGS)
+        self._init_layer()
+
+    def _databases(self):
+        return self._shards
+
+    def _database(self, key) -> diskcache.Cache:
+        return self._shards[self._hash(key) % self._count]
@@ -0,0 +1,202 @@
+"""
+codearena.py : Decrypted code shared by the worker processes
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hmac
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from hashlib import sha256
+from typing import Optional
+
+import epc.common.settings as settings
+from epc.common.codecache import get_host_key
+from epc.common.utils import Singleton
+
+# Arena: header | entries sorted by code_hash | marshal data
+ARENA_MAGIC = b'EPCARNA1'
+ARENA_HEADER = struct.Struct('<8sI')  # magic, count
+ARENA_ENTRY = struct.Struct('<32sQI32s')  # code_hash, offset, size, mac
+ARENA_SIZE = 64 * 1024 * 1024
+SHM_DIR = '/dev/shm'
+
+
+def get_arena_path() -> Optional[str]:
+    """Get the path of the code arena, None if disabled"""
+    cache_dir = os.path.abspath(settings.Config().CACHE_DIR)
+    if os.path.isdir(SHM_DIR):
+        default = os.path.join(SHM_DIR, 'epc-{}.arena'.format(sha256(cache_dir.encode('utf-8')).hexdigest()[:16]))
+    else:
+        default = os.path.join(cache_dir, 'code.arena')
+    return settings.Config().get('IMPORTER_CODE_ARENA', default) or None
+
+
+def _entry_mac(key: bytes, code_hash: bytes, data) -> bytes:
+    mac = hmac.new(key[32:], code_hash, sha256)
+    mac.update(data)
+    return mac.digest()
+
+
+def write_arena(filename: str, key: bytes, entries: dict) -> bool:
+    """Write the code_hash -> marshal data entries to a new arena, replacing the previous one atomically"""
+    code_hashes = sorted(entries)
+    offset = ARENA_HEADER.size + len(code_hashes) * ARENA_ENTRY.size
+    table = []
+    for code_hash in code_hashes:
+        data = entries[code_hash]
+        table.append(ARENA_ENTRY.pack(code_hash, offset, len(data), _entry_mac(key, code_hash, data)))
+        offset += len(data)
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(fd, 'wb') as ofile:
+            ofile.write(ARENA_HEADER.pack(ARENA_MAGIC, len(table)))
+            ofile.write(b''.join(table))
+            for code_hash in code_hashes:
+                ofile.write(entries[code_hash])
+        os.replace(tmpname, filename)
+    except OSError:
+        # The arena may be mapped by a worker (Windows)
+        try:
+            os.remove(tmpname)
+        except (OSError, UnboundLocalError):
+            pass
+        return False
+    return True
+
+
+class SharedCodeArena(metaclass=Singleton):
+    """
+    Read-only memory-mapped arena of decrypted code, published by the service and read by the workers.
+    Every entry is authenticated with the host key before use.
+    """
+
+    def __init__(self):
+        self.__filename = get_arena_path()
+        self.__key = get_host_key() if self.__filename else None
+        self.enabled = self.__key is not None
+        self.max_size = settings.Config().get('IMPORTER_CODE_ARENA_SIZE', ARENA_SIZE)
+        self.__map = None  # type: mmap.mmap
+        self.__view = None  # type: memoryview
+        self.__count = 0
+        self.__ident = None
+        self.__lock = threading.Lock()
+
+    def __reload(self) -> bool:
+        """Map the arena again if it has been replaced, returns True when it changed"""
+        try:
+            stat = os.stat(self.__filename)
+        except OSError:
+            return False
+        ident = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if ident == self.__ident:
+            return False
+        with self.__lock:
+            self.__ident = ident
+            try:
+                with open(self.__filename, 'rb') as ifile:
+                    mapped = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, count = ARENA_HEADER.unpack_from(mapped)
+            except (OSError, ValueError, struct.error):
+                return False
+            if magic != ARENA_MAGIC or len(mapped) < ARENA_HEADER.size + count * ARENA_ENTRY.size:
+                mapped.close()
+                return False
+            # The previous map is left to the garbage collector, the code being loaded may still use it
+            self.__map, self.__view, self.__count = mapped, memoryview(mapped), count
+        return True
+
+    def __find(self, code_hash: bytes):
+        mapped, count = self.__map, self.__count
+        if mapped is None:
+            return None
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            offset = ARENA_HEADER.size + mid * ARENA_ENTRY.size
+            current = mapped[offset:offset + 32]
+            if current < code_hash:
+                low = mid + 1
+            elif current > code_hash:
+                high = mid
+            else:
+                return ARENA_ENTRY.unpack_from(mapped, offset)
+        return None
+
+    def __contains__(self, code_hash: bytes) -> bool:
+        """Tell if a module is published, its data is not authenticated"""
+        if not self.enabled:
+            return False
+        if self.__find(code_hash) is not None:
+            return True
+        return self.__reload() and self.__find(code_hash) is not None
+
+    def get(self, code_hash: bytes) -> Optional[memoryview]:
+        """Get the marshal data of a module, None if it is not published or has been tampered with"""
+        if not self.enabled:
+            return None
+        entry = self.__find(code_hash)
+        if entry is None:
+            if not self.__reload():
+                return None
+            entry = self.__find(code_hash)
+            if entry is None:
+                return None
+        _, offset, size, mac = entry
+        view = self.__view
+        if offset + size > len(view):
+            return None
+        data = view[offset:offset + size]
+        if not hmac.compare_digest(mac, _entry_mac(self.__key, code_hash, data)):
+            return None
+        return data
+
+    def __entries(self) -> dict:
+        entries = dict()
+        mapped = self.__map
+        for i in range(self.__count if mapped is not None else 0):
+            code_hash = mapped[ARENA_HEADER.size + i * ARENA_ENTRY.size:ARENA_HEADER.size + i * ARENA_ENTRY.size + 32]
+            data = self.get(code_hash)
+            if data is not None:
+                entries[code_hash] = bytes(data)
+        return entries
+
+    def publish(self, entries: dict) -> int:
+        """Add code_hash -> marshal data entries to the arena, returns the number of published entries"""
+        if not self.enabled:
+            return 0
+        self.__reload()
+        current = self.__entries()
+        added = {x: y for x, y in entries.items() if x not in current}
+        if not added:
+            return 0
+
+        # Newly published code first, then the previous entries while there is room
+        size = 0
+        merged = dict()
+        for code_hash, data in list(added.items()) + list(current.items()):
+            if size + len(data) > self.max_size:
+                continue
+            merged[code_hash] = data
+            size += len(data)
+        if not write_arena(self.__filename, self.__key, merged):
+            return 0
+        self.__reload()
+        return len([x for x in added if x in merged])
@@ -0,0 +1,209 @@
+"""
+codecache.py : Caches of decrypted code for the importer
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import binascii
+import hmac
+import os
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from stat import S_ISREG
+from typing import Optional
+
+import epc.common.settings as settings
+from epc.common.cache import Cache
+from epc.common.crypto import BLOCK_SIZE, CIPHER_CTR, new_cipher
+from epc.common.utils import Singleton
+
+CODE_CACHE_SIZE = 32 * 1024 * 1024
+SEAL_KEY_SIZE = 64  # AES-256 key + HMAC-SHA256 key
+O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+
+
+_host_key = None
+
+
+def _host_key_path() -> Optional[str]:
+    """Get the path of the host key, None when it would be stored in the cache it authenticates"""
+    filename = os.path.realpath(settings.Config().get('IMPORTER_SEAL_KEY', 'seal.key'))
+    cache_dir = os.path.realpath(settings.Config().CACHE_DIR)
+    try:
+        if os.path.commonpath([filename, cache_dir]) == cache_dir:
+            return None
+    except ValueError:
+        pass  # Not on the same drive
+    return filename
+
+
+def _is_private(stat: os.stat_result) -> bool:
+    """Tell if a key file is a regular file only readable and writable by the agent user"""
+    if not S_ISREG(stat.st_mode):
+        return False
+    if not hasattr(os, 'geteuid'):
+        return True  # Windows, the ACLs are inherited from the agent directory
+    return stat.st_uid == os.geteuid() and not stat.st_mode & 0o077
+
+
+def get_host_key() -> Optional[bytes]:
+    """
+    Get the host-local key sealing the data shared by the processes of the host, created if needed.
+    The key is stored next to settings_sign.pem by default, never in CACHE_DIR.
+    None, disabling the sealed store, the manifest index and the code arena, when the key file is not private.
+    """
+    global _host_key
+    if _host_key:
+        return _host_key
+    filename = _host_key_path()
+    if not filename:
+        return None
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, 'wb') as ofile:
+            ofile.write(os.urandom(SEAL_KEY_SIZE))
+    except FileExistsError:
+        pass
+    except OSError:
+        return None
+    try:
+        fd = os.open(filename, os.O_RDONLY | O_NOFOLLOW)
+        with os.fdopen(fd, 'rb') as ifile:
+            if not _is_private(os.fstat(ifile.fileno())):
+                return None
+            key = ifile.read()
+    except OSError:
+        return None
+    if len(key) != SEAL_KEY_SIZE:
+        return None
+    _host_key = key
+    return key
+
+
+def host_mac(chunks) -> Optional[bytes]:
+    """HMAC-SHA256 of an iterable of data chunks with the host key, None when there is no host key"""
+    key = get_host_key()
+    if not key:
+        return None
+    mac = hmac.new(key[32:], digestmod=sha256)
+    for chunk in chunks:
+        mac.update(chunk)
+    return mac.digest()
+
+
+class CodeCache(metaclass=Singleton):
+    """Per-process LRU of verified and decrypted code, bounded by size"""
+
+    def __init__(self):
+        self.max_size = settings.Config().get('IMPORTER_CODE_CACHE_SIZE', CODE_CACHE_SIZE)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = OrderedDict()  # code_hash -> (code, size)
+        self.__lock = threading.Lock()
+
+    def get(self, code_hash: bytes):
+        """Get a code object, None if it is not cached"""
+        with self.__lock:
+            entry = self.__entries.get(code_hash)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(code_hash)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, code_hash: bytes, code, size: int) -> bool:
+        """Add a code object, size being the length of its serialized form"""
+        if size > self.max_size:
+            return False
+        with self.__lock:
+            old = self.__entries.pop(code_hash, None)
+            if old is not None:
+                self.size -= old[1]
+            self.__entries[code_hash] = (code, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.__entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+        return True
+
+    def clear(self) -> None:
+        """Drop all the cached code"""
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        """Get the cache counters"""
+        return dict(
+            entries=len(self.__entries),
+            size=self.size,
+            max_size=self.max_size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions
+        )
+
+
+class SealedCodeStore(metaclass=Singleton):
+    """
+    On-disk cache of verified and decrypted code, shared by all the processes of the host.
+    Entries are keyed by manifest code_hash and sealed (AES-CTR + HMAC-SHA256) with a host-local key.
+    """
+
+    def __init__(self):
+        self.enabled = settings.Config().get('IMPORTER_SEALED_CACHE', True)
+        self.expire = settings.Config().get('IMPORTER_SEALED_EXPIRE', 7 * 86400)
+        self.__key = get_host_key() if self.enabled else None
+
+    @staticmethod
+    def __cache_key(code_hash: bytes) -> str:
+        return 'sealed_{}'.format(binascii.hexlify(code_hash).decode('ascii'))
+
+    def __cipher(self, nonce: bytes, encrypt: bool = False):
+        return new_cipher(CIPHER_CTR, self.__key[:32], nonce, encrypt)
+
+    def __mac(self, code_hash: bytes, nonce: bytes, data: bytes) -> bytes:
+        return hmac.new(self.__key[32:], code_hash + nonce + data, sha256).digest()
+
+    def get(self, code_hash: bytes) -> Optional[bytes]:
+        """Get the decrypted code, None if it is not stored or has been tampered with"""
+        if not self.__key:
+            return None
+        sealed = Cache().get(self.__cache_key(code_hash), metrics_tag='importer')
+        if not sealed or len(sealed) < 32 + BLOCK_SIZE:
+            return None
+        mac, nonce, data = sealed[:32], sealed[32:32 + BLOCK_SIZE], sealed[32 + BLOCK_SIZE:]
+        if not hmac.compare_digest(mac, self.__mac(code_hash, nonce, data)):
+            return None
+        return self.__cipher(nonce).update(data)
+
+    def set(self, code_hash: bytes, code: bytes) -> bool:
+        """Store decrypted code that has been verified against the manifest"""
+        if not self.__key:
+            return False
+        nonce = os.urandom(BLOCK_SIZE)
+        data = self.__cipher(nonce, encrypt=True).update(code)
+        return Cache().set(self.__cache_key(code_hash),
+                           self.__mac(code_hash, nonce, data) + nonce + data,
+                           expire=self.expire,
+                           tag='importer')
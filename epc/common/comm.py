@@ -20,6 +20,9 @@ along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
 import requests
 import random
+import threading
+
+from urllib3.util.request import ACCEPT_ENCODING
 
 from epc import __version__
 import epc.common.settings as settings
@@ -31,6 +34,10 @@ class EPSession(requests.Session):
     def __init__(self):
         super().__init__()
         self.__routes = None
+        # Content encodings decoded by urllib3 (brotli and zstd are added when their package is installed)
+        self.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        self.__stats = dict()  # route -> [responses, wire bytes, decoded bytes]
+        self.__stats_lock = threading.Lock()
         # Don't trust env for proxies
         self.trust_env = False
         # Add custom anchor
@@ -114,7 +121,7 @@ class EPSession(requests.Session):
                 raise CommException("No Instance ID...refusing communication")
         proxies = settings.Config().PROXIES
 
-        return super(EPSession, self).request(
+        response = super(EPSession, self).request(
             method,
             url,
             params,
@@ -131,6 +138,30 @@ class EPSession(requests.Session):
             verify,
             cert,
             json)
+        if not stream:
+            self.record_transfer(url, response, len(response.content))
+        return response
+
+    def record_transfer(self, url: str, response: requests.Response, decoded_size: int) -> None:
+        """Account for a consumed response, streamed responses must be recorded by the caller"""
+        try:
+            wire_size = response.raw.tell()  # Bytes read from the socket, before decoding
+        except (AttributeError, OSError, ValueError):
+            wire_size = decoded_size
+        route = url.split('/')[0] if not url.startswith('http') else url.split('?')[0]
+        with self.__stats_lock:
+            stats = self.__stats.setdefault(route, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += wire_size
+            stats[2] += decoded_size
+
+    def transfer_stats(self) -> dict:
+        """Bytes received per route, on the wire and once decoded"""
+        with self.__stats_lock:
+            return {
+                route: dict(responses=stats[0], wire_bytes=stats[1], decoded_bytes=stats[2])
+                for route, stats in self.__stats.items()
+            }
 
 
 req_sess = EPSession()
@@ -0,0 +1,425 @@
+"""
+crypto.py : Ciphers used for code payloads
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List
+
+try:
+    from Crypto.Cipher import AES
+    from Crypto.Hash import SHA512
+    from Crypto.PublicKey import RSA
+    from Crypto.Signature import PKCS1_PSS
+    from Crypto.Util import Counter
+    try:
+        from Crypto.PublicKey import ECC
+        from Crypto.Signature import eddsa
+    except ImportError:
+        eddsa = None  # Only in pycryptodome >= 3.15
+except ImportError:
+    AES = None
+    eddsa = None
+
+try:
+    from cryptography.exceptions import InvalidSignature, InvalidTag
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+    try:
+        from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+    except ImportError:
+        Ed25519PublicKey = None  # Only in cryptography >= 2.6
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.serialization import load_pem_public_key
+    try:
+        from cryptography.hazmat.decrepit.ciphers.modes import CFB, CFB8
+    except ImportError:
+        from cryptography.hazmat.primitives.ciphers.modes import CFB, CFB8
+except ImportError:
+    Cipher = None
+    Ed25519PublicKey = None
+
+BLOCK_SIZE = 16
+
+# Payload cipher modes, payloads are: iv | ciphertext [| tag]
+CIPHER_CFB8 = 0  # Legacy mode, one block operation per byte
+CIPHER_CFB128 = 1
+CIPHER_CTR = 2
+CIPHER_GCM = 3
+
+CIPHER_NAMES = {
+    CIPHER_CFB8: 'CFB-8',
+    CIPHER_CFB128: 'CFB-128',
+    CIPHER_CTR: 'CTR',
+    CIPHER_GCM: 'GCM',
+}
+
+IV_SIZES = {
+    CIPHER_CFB8: BLOCK_SIZE,
+    CIPHER_CFB128: BLOCK_SIZE,
+    CIPHER_CTR: BLOCK_SIZE,  # Initial counter block
+    CIPHER_GCM: 12,
+}
+
+GCM_TAG_SIZE = 16
+PSS_SALT_SIZE = 64  # PKCS1_PSS default for SHA512
+
+# Manifest signature types, any unknown type is checked as RSA-PSS SHA512
+SIGNATURE_RSA_PSS = 0
+SIGNATURE_ED25519 = 2
+ED25519_SIGNATURE_SIZE = 64
+
+
+class PyCryptoContext(object):
+    """
+    Cipher context on top of a PyCrypto cipher object.
+    PyCrypto 2.x only processes whole CFB segments, a final partial segment is padded and its output truncated:
+    only the last update may not be a multiple of segment_size.
+    """
+
+    def __init__(self, cipher, encrypt: bool, segment_size: int = 1):
+        self.__cipher = cipher
+        self.__encrypt = encrypt
+        self.__segment_size = segment_size
+        self.__process = cipher.encrypt if encrypt else cipher.decrypt
+        self.update = self.__process if segment_size == 1 else self.__update_segments
+
+    def __update_segments(self, data: bytes) -> bytes:
+        tail = len(data) % self.__segment_size
+        if not tail:
+            return self.__process(data)
+        return self.__process(data + b'\0' * (self.__segment_size - tail))[:len(data)]
+
+    def finalize(self, tag: bytes = b'') -> bytes:
+        """
+        End the operation, returns the tag when encrypting and checks it when decrypting
+
+        Raises: ValueError
+        """
+        if not hasattr(self.__cipher, 'digest'):
+            return b''
+        if self.__encrypt:
+            return self.__cipher.digest()
+        self.__cipher.verify(tag)
+        return b''
+
+
+class PyCryptoBackend(object):
+    """Pure python backend, AES is accelerated by pycryptodome but not by the original PyCrypto"""
+    name = 'pycrypto'
+
+    @staticmethod
+    def available() -> bool:
+        return AES is not None
+
+    @staticmethod
+    def has_ed25519() -> bool:
+        return eddsa is not None
+
+    @staticmethod
+    def new_cipher(mode: int, key: bytes, iv: bytes, encrypt: bool = False) -> PyCryptoContext:
+        """
+        Create an AES cipher context for a payload mode
+
+        Raises: ValueError
+        """
+        if mode == CIPHER_CFB8:
+            cipher = AES.new(key, AES.MODE_CFB, iv)
+        elif mode == CIPHER_CFB128:
+            return PyCryptoContext(AES.new(key, AES.MODE_CFB, iv, segment_size=128), encrypt, BLOCK_SIZE)
+        elif mode == CIPHER_CTR:
+            cipher = AES.new(key, AES.MODE_CTR, counter=Counter.new(128, initial_value=int.from_bytes(iv, 'big')))
+        elif mode == CIPHER_GCM and hasattr(AES, 'MODE_GCM'):
+            cipher = AES.new(key, AES.MODE_GCM, nonce=iv)
+        else:
+            raise ValueError('Unsupported cipher mode {}'.format(mode))
+        return PyCryptoContext(cipher, encrypt)
+
+    @staticmethod
+    @lru_cache(16)
+    def __load_rsa(pubkey: str):
+        return PKCS1_PSS.new(RSA.importKey(pubkey))
+
+    def verify_signature(self, pubkey: str, chunks, signature: bytes) -> bool:
+        """Check a RSA-PSS SHA512 signature over an iterable of data chunks"""
+        hashalgo = SHA512.new()
+        for chunk in chunks:
+            hashalgo.update(chunk)
+        return self.__load_rsa(pubkey).verify(hashalgo, signature)
+
+    @staticmethod
+    @lru_cache(16)
+    def __load_ed25519(pubkey: str):
+        return eddsa.new(ECC.import_key(pubkey), 'rfc8032')
+
+    def verify_ed25519(self, pubkey: str, data: bytes, signature: bytes) -> bool:
+        """Check an Ed25519 signature"""
+        try:
+            self.__load_ed25519(pubkey).verify(data, signature)
+        except ValueError:
+            return False
+        return True
+
+
+class OpenSSLContext(object):
+    """Cipher context on top of a cryptography cipher context"""
+
+    def __init__(self, context, encrypt: bool, gcm: bool):
+        self.__context = context
+        self.__encrypt = encrypt
+        self.__gcm = gcm
+        self.update = context.update
+
+    def finalize(self, tag: bytes = b'') -> bytes:
+        """
+        End the operation, returns the tag when encrypting and checks it when decrypting
+
+        Raises: ValueError
+        """
+        if not self.__gcm:
+            self.__context.finalize()
+            return b''
+        if self.__encrypt:
+            self.__context.finalize()
+            return self.__context.tag
+        try:
+            self.__context.finalize_with_tag(tag)
+        except InvalidTag:
+            raise ValueError('MAC check failed')
+        return b''
+
+
+class OpenSSLBackend(object):
+    """OpenSSL backend using the cryptography package, AES-NI is used when the CPU supports it"""
+    name = 'openssl'
+
+    @staticmethod
+    def available() -> bool:
+        return Cipher is not None
+
+    @staticmethod
+    def has_ed25519() -> bool:
+        return Ed25519PublicKey is not None
+
+    @staticmethod
+    def new_cipher(mode: int, key: bytes, iv: bytes, encrypt: bool = False) -> OpenSSLContext:
+        """
+        Create an AES cipher context for a payload mode
+
+        Raises: ValueError
+        """
+        if mode == CIPHER_CFB8:
+            cipher_mode = CFB8(iv)
+        elif mode == CIPHER_CFB128:
+            cipher_mode = CFB(iv)
+        elif mode == CIPHER_CTR:
+            cipher_mode = modes.CTR(iv)
+        elif mode == CIPHER_GCM:
+            cipher_mode = modes.GCM(iv)
+        else:
+            raise ValueError('Unsupported cipher mode {}'.format(mode))
+        cipher = Cipher(algorithms.AES(key), cipher_mode, backend=default_backend())
+        return OpenSSLContext(cipher.encryptor() if encrypt else cipher.decryptor(), encrypt, mode == CIPHER_GCM)
+
+    @staticmethod
+    @lru_cache(16)
+    def __load_rsa(pubkey: str):
+        return load_pem_public_key(pubkey.encode('ascii'), backend=default_backend())
+
+    def verify_signature(self, pubkey: str, chunks, signature: bytes) -> bool:
+        """Check a RSA-PSS SHA512 signature over an iterable of data chunks"""
+        hashalgo = hashes.Hash(hashes.SHA512(), backend=default_backend())
+        for chunk in chunks:
+            hashalgo.update(chunk)
+        try:
+            self.__load_rsa(pubkey).verify(
+                signature,
+                hashalgo.finalize(),
+                padding.PSS(mgf=padding.MGF1(hashes.SHA512()), salt_length=PSS_SALT_SIZE),
+                Prehashed(hashes.SHA512()))
+        except (InvalidSignature, ValueError):
+            return False
+        return True
+
+    @staticmethod
+    @lru_cache(16)
+    def __load_ed25519(pubkey: str):
+        key = load_pem_public_key(pubkey.encode('ascii'), backend=default_backend())
+        if not isinstance(key, Ed25519PublicKey):
+            raise ValueError('Not an Ed25519 public key')
+        return key
+
+    def verify_ed25519(self, pubkey: str, data: bytes, signature: bytes) -> bool:
+        """Check an Ed25519 signature"""
+        try:
+            self.__load_ed25519(pubkey).verify(signature, data)
+        except (InvalidSignature, ValueError):
+            return False
+        return True
+
+
+# Backends by order of preference
+BACKENDS = OrderedDict((backend.name, backend) for backend in [OpenSSLBackend(), PyCryptoBackend()])
+_backend = None
+
+
+def available_backends() -> List[str]:
+    """Names of the backends that can be used on this host"""
+    return [name for name, backend in BACKENDS.items() if backend.available()]
+
+
+def get_backend(name: str = None):
+    """
+    Get a backend by name, or the selected one (the fastest available by default).
+    This does not depend on the settings as they are verified with it.
+
+    Raises: ValueError, ImportError
+    """
+    global _backend
+    if name is not None:
+        backend = BACKENDS.get(name)
+        if backend is None or not backend.available():
+            raise ValueError('Crypto backend {} is not available'.format(name))
+        return backend
+    if _backend is None:
+        names = available_backends()
+        if not names:
+            raise ImportError('No crypto backend available, install pycrypto or cryptography')
+        _backend = BACKENDS[names[0]]
+    return _backend
+
+
+def select_backend(name: str) -> None:
+    """
+    Select the backend used by default
+
+    Raises: ValueError
+    """
+    global _backend
+    _backend = get_backend(name)
+
+
+def new_cipher(mode: int, key: bytes, iv: bytes, encrypt: bool = False, backend=None):
+    """
+    Create an AES cipher context for a payload mode
+
+    Raises: ValueError
+    """
+    return (backend or get_backend()).new_cipher(mode, key, iv, encrypt)
+
+
+def verify_signature(pubkey: str, chunks, signature: bytes, signature_type: int = SIGNATURE_RSA_PSS,
+                     backend=None) -> bool:
+    """
+    Check a signature over an iterable of data chunks.
+    Ed25519 signatures are zero padded up to the size of the RSA ones.
+    """
+    backend = backend or get_backend()
+    if signature_type != SIGNATURE_ED25519:
+        return backend.verify_signature(pubkey, chunks, signature)
+
+    if not backend.has_ed25519():
+        backends = [x for x in BACKENDS.values() if x.available() and x.has_ed25519()]
+        if not backends:
+            return False
+        backend = backends[0]
+    if not pubkey or len(signature) < ED25519_SIGNATURE_SIZE or any(signature[ED25519_SIGNATURE_SIZE:]):
+        return False
+    return backend.verify_ed25519(pubkey, b''.join(chunks), signature[:ED25519_SIGNATURE_SIZE])
+
+
+class PayloadDecryptor(object):
+    """
+    Incremental decryption of a payload.
+    Data is fed to the cipher in whole blocks, the GCM tag is held back until finalize().
+    """
+
+    def __init__(self, mode: int, key: bytes, backend=None):
+        if mode not in IV_SIZES:
+            raise ValueError('Unsupported cipher mode {}'.format(mode))
+        self.__mode = mode
+        self.__key = key
+        self.__backend = backend
+        self.__iv_size = IV_SIZES[mode]
+        self.__tag_size = GCM_TAG_SIZE if mode == CIPHER_GCM else 0
+        self.__cipher = None
+        self.__pending = b''
+
+    def update(self, data: bytes) -> bytes:
+        """Decrypt the next part of the payload, returns the available plaintext"""
+        if self.__pending:
+            data = self.__pending + data
+            self.__pending = b''
+        if self.__cipher is None:
+            if len(data) < self.__iv_size:
+                self.__pending = data
+                return b''
+            self.__cipher = new_cipher(self.__mode, self.__key, data[:self.__iv_size], backend=self.__backend)
+            data = data[self.__iv_size:]
+
+        usable = len(data) - self.__tag_size
+        usable -= usable % BLOCK_SIZE
+        if usable <= 0:
+            self.__pending = data
+            return b''
+        self.__pending = data[usable:]
+        return self.__cipher.update(data[:usable])
+
+    def finalize(self) -> bytes:
+        """
+        Decrypt the end of the payload and check its tag
+
+        Raises: ValueError
+        """
+        if self.__cipher is None:
+            raise ValueError('Truncated payload')
+        data = self.__pending
+        self.__pending = b''
+        if len(data) < self.__tag_size:
+            raise ValueError('Truncated payload')
+        tag = data[len(data) - self.__tag_size:]
+        data = data[:len(data) - self.__tag_size]
+        plain = self.__cipher.update(data) if data else b''
+        self.__cipher.finalize(tag)
+        return plain
+
+
+def decrypt_payload(mode: int, key: bytes, data: bytes, backend=None) -> bytes:
+    """
+    Decrypt a whole payload
+
+    Raises: ValueError
+    """
+    decryptor = PayloadDecryptor(mode, key, backend)
+    return decryptor.update(data) + decryptor.finalize()
+
+
+def encrypt_payload(mode: int, key: bytes, data: bytes, backend=None) -> bytes:
+    """
+    Encrypt a payload the way the server does
+
+    Raises: ValueError
+    """
+    iv = os.urandom(IV_SIZES[mode])
+    cipher = new_cipher(mode, key, iv, encrypt=True, backend=backend)
+    data = cipher.update(data)
+    return iv + data + cipher.finalize()
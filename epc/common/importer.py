@@ -20,38 +20,219 @@ along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
 import _imp
 import binascii
+import hmac
+import itertools
 import logging
 import marshal
 import os
+import re
 import shutil
 import struct
 import sys
+import tempfile
 import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from io import BytesIO
 from hashlib import sha256
 from importlib.abc import MetaPathFinder, InspectLoader
 from importlib.machinery import ModuleSpec
-from io import BytesIO
-from typing import Optional
+from threading import Lock, RLock, Thread
+from typing import List, Optional
 
 import epc.common.settings as settings
-from epc.common.kaitaistruct import KaitaiStream
-from epc.common.manifest import Manifest
-from Crypto.Cipher import AES
-from Crypto.Hash import SHA512
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_PSS
-from epc.common.cache import Cache
+from epc.common.manifest import (DeltaRecord, ManifestBodyRecord, ModuleRecord, DELTA_BODY, DELTA_MAGIC, MANIFEST_BODY,
+                                  MODULE_RECORD, NAME_HASH_SIZE, parse_delta, parse_manifest)
+from epc.common.bundle import get_bundle
+from epc.common.cache import Cache, CACHE_SETTINGS
+from epc.common.codearena import SharedCodeArena
+from epc.common.codecache import CodeCache, SealedCodeStore, host_mac
 from epc.common.comm import req_sess, CommException
+from epc.common.crypto import SIGNATURE_ED25519, PayloadDecryptor, decrypt_payload, verify_signature
+from epc.common.importprofile import get_profiler, profile_module, profile_phase
+from epc.common.manifest_index import ManifestIndex, manifest_digest, remove_index, write_index
+from epc.common.utils import KeyedLock
 
 FLAG_PKG = 1
 FLAG_BIN = 2
 FLAG_NOCACHE = 4
+FLAG_ZLIB = 0x40  # Code compressed before encryption, encrypted data does not compress on the wire
+FLAG_CIPHER_MASK = 0x30  # Payload cipher mode, see epc.common.crypto
+FLAG_CIPHER_SHIFT = 4
+
+# Code packs: several encrypted modules framed in a single code_pkg response
+PACK_MAGIC = b'EPCCPACK'
+PACK_HEADER = struct.Struct('<8sH')  # magic, count
+PACK_ENTRY = struct.Struct('<32sI')  # name_hash, size
+
+STREAM_CHUNK = 64 * 1024
+
+# Digests of the manifest bodies and deltas whose signature has been checked by this process
+VERIFIED_CACHE_SIZE = 256
+_verified_bodies = OrderedDict()
+_verified_lock = Lock()
+
+# Deltas applied on top of a full manifest, the next update is a full manifest so that the chain stays short
+MAX_DELTAS = 16
+
+# Held by name_hash while a module is downloaded or decrypted, the other threads wait and reuse the result
+_module_locks = KeyedLock()
+
+
+def _max_age(headers) -> int:
+    """Get the cache duration from the response headers"""
+    cache_time = headers.get('Cache-Control')
+    if cache_time and cache_time.startswith('max-age='):
+        try:
+            return int(cache_time[8:])
+        except ValueError:
+            pass
+    return 0
+
+
+def _validators_key(key: str) -> str:
+    return '{}_validators'.format(key)
+
+
+def _cache_expire(max_age: int) -> int:
+    """Cache entries outlive their max-age so that they can be revalidated instead of downloaded again"""
+    return max_age + settings.Config().get('IMPORTER_REVALIDATE_GRACE', 7 * 86400)
+
+
+def _cache_response(key: str, value, headers, read: bool = False) -> Optional[dict]:
+    """
+    Cache a response body along with its validators.
+    Returns the validators, None when the response cannot be cached.
+    """
+    max_age = _max_age(headers)
+    validators = dict(
+        fresh_until=time.time() + max_age,
+        max_age=max_age,
+        expire=max_age,
+        etag=headers.get('ETag'),
+        last_modified=headers.get('Last-Modified')
+    )
+    if not (validators['etag'] or validators['last_modified']):
+        # Cannot be revalidated, fresh until it expires
+        if max_age <= 0:
+            return None
+        Cache().set(key, value, expire=max_age, read=read, tag='importer')
+        Cache().delete(_validators_key(key), metrics_tag='importer')
+        return validators
+
+    validators['expire'] = _cache_expire(max_age)
+    Cache().set(key, value, expire=validators['expire'], read=read, tag='importer')
+    Cache().set(_validators_key(key), validators, expire=validators['expire'], tag='importer')
+    return validators
+
+
+def _is_fresh(key: str) -> bool:
+    """Tell if a cache entry can be used without revalidation"""
+    validators = Cache().get(_validators_key(key), metrics_tag='importer')
+    return validators is None or time.time() < validators['fresh_until']
+
+
+def _conditional_headers(key: str) -> dict:
+    """Request headers revalidating a cache entry"""
+    validators = Cache().get(_validators_key(key), metrics_tag='importer')
+    headers = dict()
+    if validators is None or key not in Cache():
+        return headers
+    if validators['etag']:
+        headers['If-None-Match'] = validators['etag']
+    if validators['last_modified']:
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def _revalidated(key: str, headers, *others: str) -> Optional[dict]:
+    """
+    Extend a cache entry, and the entries stored along with it, after a 304 response.
+    Returns the updated validators, None when the entry is gone.
+    """
+    validators = Cache().get(_validators_key(key), metrics_tag='importer')
+    if validators is None:
+        return None
+    max_age = _max_age(headers) or validators['max_age']
+    validators.update(
+        fresh_until=time.time() + max_age,
+        max_age=max_age,
+        etag=headers.get('ETag') or validators['etag'],
+        last_modified=headers.get('Last-Modified') or validators['last_modified']
+    )
+    validators['expire'] = _cache_expire(max_age)
+    if not Cache().touch(key, validators['expire']):
+        return None
+    for other in others:
+        Cache().touch(other, validators['expire'])
+    Cache().set(_validators_key(key), validators, expire=validators['expire'], tag='importer')
+    return validators
+
+
+def _signed_digest(pubkey: Optional[str], chunks, signature: bytes) -> bytes:
+    """Digest of signed data, covering the key and the signature so that it is only trusted again if neither changed"""
+    hashalgo = sha256((pubkey or '').encode('ascii'))
+    for chunk in chunks:
+        hashalgo.update(chunk)
+    hashalgo.update(signature)
+    return hashalgo.digest()
+
+
+def _is_verified(digest: bytes) -> bool:
+    """Tell if the signature of some data has already been checked by this process"""
+    with _verified_lock:
+        if digest not in _verified_bodies:
+            return False
+        _verified_bodies.move_to_end(digest)
+        return True
+
+
+@lru_cache(maxsize=4096)
+def _name_hash(fullname: str) -> bytes:
+    """Hash of a module name, as found in the manifest"""
+    return sha256(fullname.encode('ascii')).digest()
+
+
+def _signing_key(signature_type: int) -> Optional[str]:
+    """Public key checking the manifests signed with signature_type"""
+    if signature_type == SIGNATURE_ED25519:
+        return settings.Config().SIGN_PUBKEY_ED25519
+    return settings.Config().SIGN_PUBKEY
+
+
+def _read_chunks(ifile):
+    """Iterate over the contents of a file"""
+    return iter(lambda: ifile.read(STREAM_CHUNK), b'')
+
+
+def _file_mac(filename: str, code_hash: bytes) -> Optional[bytes]:
+    """Host MAC of a decrypted file"""
+    with open(filename, 'rb') as ifile:
+        return host_mac(itertools.chain([code_hash], _read_chunks(ifile)))
+
+
+def _split_pack(data: bytes):
+    """Split a code pack into (name_hash, encrypted data) tuples"""
+    view = memoryview(data)
+    magic, count = PACK_HEADER.unpack_from(view)
+    if magic != PACK_MAGIC:
+        raise ImportError('Invalid code pack')
+    offset = PACK_HEADER.size
+    for _ in range(count):
+        name_hash, size = PACK_ENTRY.unpack_from(view, offset)
+        offset += PACK_ENTRY.size
+        if offset + size > len(view):
+            raise ImportError('Truncated code pack')
+        yield name_hash, bytes(view[offset:offset + size])
+        offset += size
 
 
 class Module(object):
     """Code module"""
 
-    def __init__(self, module: Manifest.Module):
+    def __init__(self, module: ModuleRecord):
         self.__module = module
         self.name_hash = self.__module.name_hash
         self.flags = self.__module.flags
@@ -60,58 +241,116 @@ class Module(object):
         self.is_pkg = True if self.flags & FLAG_PKG else False
         self.is_bin = True if self.flags & FLAG_BIN else False
         self.no_cache = True if self.flags & FLAG_NOCACHE else False
+        self.cipher_mode = (self.flags & FLAG_CIPHER_MASK) >> FLAG_CIPHER_SHIFT
+        self.compressed = True if self.flags & FLAG_ZLIB else False
         self.__data = b''
 
+    @property
+    def cache_key(self) -> str:
+        """Key of the encrypted data in the cache"""
+        return '{}'.format(binascii.hexlify(self.name_hash))
+
+    def set_data(self, data: bytes) -> bool:
+        """Use encrypted data fetched by other means (e.g. a code pack)"""
+        if sha256(data).digest() != self.code_hash:
+            return False
+        self.__data = data
+        return True
+
     def __decrypt_code(self) -> bytes:
         if not self.__data:
             raise ImportError('Module {} is does not exists'.format(
                 binascii.hexlify(self.name_hash)))
 
         # Check hashs before importing
-        hashcode = sha256(self.__data).digest()
+        with profile_phase('hash', len(self.__data)):
+            hashcode = sha256(self.__data).digest()
         if hashcode != self.code_hash:
             raise ImportError('Module {} is corrupted (bad hash)'.format(
                 binascii.hexlify(self.name_hash)))
 
-        aes_iv = self.__data[:AES.block_size]
-        cipher = AES.new(self.__key, AES.MODE_CFB, aes_iv)
-        return cipher.decrypt(self.__data[AES.block_size:])
+        try:
+            with profile_phase('decrypt', len(self.__data)):
+                code = decrypt_payload(self.cipher_mode, self.__key, self.__data)
+                if self.compressed:
+                    code = zlib.decompress(code)
+        except (ValueError, zlib.error) as exc:
+            raise ImportError('Module {} cannot be decrypted : {}'.format(
+                binascii.hexlify(self.name_hash), exc))
+        # The encrypted data is not needed anymore once decrypted
+        self.__data = b''
+        return code
+
+    @property
+    def in_bundle(self) -> bool:
+        """Tell if this version of the module is in the offline bundle"""
+        bundle = get_bundle()
+        return bundle is not None and bundle.get(self.name_hash, self.code_hash) is not None
+
+    def __load_from_bundle(self) -> bool:
+        bundle = get_bundle()
+        data = bundle.get(self.name_hash, self.code_hash) if bundle else None
+        return data is not None and self.set_data(bytes(data))
+
+    def __discard_cache(self) -> None:
+        """Drop the cached data and its validators, so that it is downloaded again instead of revalidated"""
+        Cache().delete_many([self.cache_key, _validators_key(self.cache_key)], metrics_tag='importer')
 
     def __load_from_cache(self) -> bytes:
+        cached = False
         try:
-            self.__data = Cache().get('{}'.format(binascii.hexlify(self.name_hash)))
+            if not self.__data:
+                with profile_phase('cache'):
+                    if not _is_fresh(self.cache_key):
+                        return b''
+                    self.__data = Cache().get(self.cache_key, metrics_tag='importer')
+                    cached = self.__data is not None
             return self.__decrypt_code()
         except ImportError:
+            if cached:
+                self.__discard_cache()
             self.__data = b''
             return b''
 
     def get_code(self) -> bytes:
-        """Get the actual code"""
+        """Get the actual code, a module is downloaded by a single thread at a time"""
+        with _module_locks.hold(self.name_hash):
+            return self.__get_code()
+
+    def __get_code(self) -> bytes:
+        if not self.__data:
+            self.__load_from_bundle()
         code = self.__load_from_cache()
 
         if not code:
             try:
-                req = req_sess.get(
-                    'code_pkg',
-                    params={'id': binascii.hexlify(self.name_hash)})
+                params = {'id': binascii.hexlify(self.name_hash)}
+                headers = _conditional_headers(self.cache_key)
+                with profile_phase('fetch') as phase:
+                    req = req_sess.get(
+                        'code_pkg',
+                        params=params,
+                        headers=headers)
+                    phase.size = len(req.content)
+                if req.status_code == 304 and headers:
+                    self.__data = Cache().get(self.cache_key, metrics_tag='importer') or b''
+                    if self.__data:
+                        try:
+                            code = self.__decrypt_code()
+                            _revalidated(self.cache_key, req.headers)
+                            return code
+                        except ImportError:
+                            self.__data = b''
+                    # Evicted or corrupted since the request was made
+                    self.__discard_cache()
+                    req = req_sess.get(
+                        'code_pkg',
+                        params=params)
                 if req.status_code != 200:
                     raise ImportError('Module {} does not exists'.format(
                         binascii.hexlify(self.name_hash)))
                 self.__data = req.content
-
-                cache_time = req.headers.get('Cache-Control')
-                if cache_time and cache_time.startswith('max-age='):
-                    try:
-                        cache_time = int(cache_time[8:])
-                        if cache_time > 0:
-                            Cache().set(
-                                '{}'.format(binascii.hexlify(self.name_hash)),
-                                self.__data,
-                                expire=cache_time,
-                                tag='importer'
-                            )
-                    except:
-                        pass
+                _cache_response(self.cache_key, self.__data, req.headers)
             except ImportError:
                 raise  # Throw the original ImportError
             except Exception as exc:
@@ -119,88 +358,498 @@ class Module(object):
             code = self.__decrypt_code()
         return code
 
+    def __stream_decrypt(self, chunks, ofile) -> None:
+        """Hash and decrypt the encrypted chunks into ofile, which must be discarded on ImportError"""
+        hashalgo = sha256()
+        try:
+            decryptor = PayloadDecryptor(self.cipher_mode, self.__key)
+            decompressor = zlib.decompressobj() if self.compressed else None
+            write = (lambda x: ofile.write(decompressor.decompress(x))) if decompressor else ofile.write
+            for chunk in chunks:
+                hashalgo.update(chunk)
+                write(decryptor.update(chunk))
+            if hashalgo.digest() != self.code_hash:
+                raise ImportError('Module {} is corrupted (bad hash)'.format(
+                    binascii.hexlify(self.name_hash)))
+            write(decryptor.finalize())
+            if decompressor:
+                ofile.write(decompressor.flush())
+                if not decompressor.eof:
+                    raise ValueError('Truncated compressed code')
+        except (ValueError, zlib.error) as exc:
+            raise ImportError('Module {} cannot be decrypted : {}'.format(
+                binascii.hexlify(self.name_hash), exc))
+
+    def __write_from_bundle(self, ofile) -> bool:
+        bundle = get_bundle()
+        data = bundle.get(self.name_hash, self.code_hash) if bundle else None
+        if data is None:
+            return False
+        try:
+            self.__stream_decrypt((data[i:i + STREAM_CHUNK] for i in range(0, len(data), STREAM_CHUNK)), ofile)
+            return True
+        except ImportError:
+            ofile.seek(0)
+            ofile.truncate()
+            return False
+
+    def __write_from_cache(self, ofile, revalidated: bool = False) -> bool:
+        if not (revalidated or _is_fresh(self.cache_key)):
+            return False
+        cached = Cache().get(self.cache_key, read=True, metrics_tag='importer')
+        if cached is None:
+            return False
+        if isinstance(cached, bytes):
+            cached = BytesIO(cached)
+        with cached:
+            try:
+                self.__stream_decrypt(_read_chunks(cached), ofile)
+                return True
+            except ImportError:
+                ofile.seek(0)
+                ofile.truncate()
+        self.__discard_cache()
+        return False
+
+    def write_code(self, ofile) -> None:
+        """
+        Write the actual code into a file, streaming it from the cache or the server
+        so that large modules are never held in memory.
+        The file must be discarded on ImportError.
+        """
+        if self.__data:
+            ofile.write(self.__decrypt_code())
+            return
+        if self.__write_from_bundle(ofile) or self.__write_from_cache(ofile):
+            return
+
+        try:
+            params = {'id': binascii.hexlify(self.name_hash)}
+            headers = _conditional_headers(self.cache_key)
+            with profile_phase('fetch'):
+                req = req_sess.get(
+                    'code_pkg',
+                    params=params,
+                    headers=headers,
+                    stream=True)
+            if req.status_code == 304 and headers:
+                if self.__write_from_cache(ofile, revalidated=True):
+                    _revalidated(self.cache_key, req.headers)
+                    return
+                # Evicted or corrupted since the request was made
+                self.__discard_cache()
+                req = req_sess.get(
+                    'code_pkg',
+                    params=params,
+                    stream=True)
+            if req.status_code != 200:
+                raise ImportError('Module {} does not exists'.format(
+                    binascii.hexlify(self.name_hash)))
+            with tempfile.TemporaryFile() as encfile, profile_phase('fetch') as phase:
+                def chunks():
+                    for chunk in req.iter_content(STREAM_CHUNK):
+                        encfile.write(chunk)
+                        yield chunk
+
+                self.__stream_decrypt(chunks(), ofile)
+                phase.size = encfile.tell()
+                req_sess.record_transfer('code_pkg', req, encfile.tell())
+                encfile.seek(0)
+                _cache_response(self.cache_key, encfile, req.headers, read=True)
+        except ImportError:
+            raise  # Throw the original ImportError
+        except Exception as exc:
+            raise ImportError('Unknown exception : {}'.format(exc))
+
+
+class ManifestDeltaError(ImportError):
+    """A manifest delta cannot be applied on top of the current manifest"""
+
 
 class ManifestManager(object):
     """Manifest for EPLoader"""
 
     def __init__(self, data=b''):
         self.__data = data
-        self.__manifest = None  # type: Manifest
-        self.__modules = dict()
+        self.__bodies = None  # type: List[ManifestBodyRecord]
+        self.__records = dict()  # name_hash -> (name_hash, flags, key, code_hash)
+        self.__modules = dict()  # Module objects, created on first use
+        self.__deltas = []  # Verified deltas applied on top of the manifest
+        self.__index = None  # type: ManifestIndex
         self.__parse_exc = None
+        self.__lock = RLock()  # Held while the manifest is loaded or updated
         self.timestamp = 0
 
+    def copy(self) -> 'ManifestManager':
+        """Get a copy that can be updated without altering this manifest"""
+        manifest = ManifestManager(self.__data)
+        with self.__lock:
+            manifest.__bodies = self.__bodies
+            manifest.__records = dict(self.__records)  # The mapped index is read-only
+            manifest.__modules = dict(self.__modules)
+            manifest.__deltas = list(self.__deltas)
+            manifest.__index = self.__index
+            manifest.timestamp = self.timestamp
+        return manifest
+
+    def __update(self, manifest: 'ManifestManager') -> None:
+        """Use the state of a copy that has been refreshed"""
+        self.__data = manifest.__data
+        self.__bodies = manifest.__bodies
+        self.__records = manifest.__records
+        self.__modules = manifest.__modules
+        self.__deltas = manifest.__deltas
+        self.__index = manifest.__index
+        self.timestamp = manifest.timestamp
+
     def __parse(self):
         try:
-            self.__manifest = Manifest(KaitaiStream(BytesIO(self.__data)))
-            for manifest in self.__manifest.manifests:  # type: Manifest.ManifestBody
-                self.__modules.update({x.name_hash: Module(x) for x in manifest.modules})
+            self.__bodies = parse_manifest(self.__data)
+            self.__records = dict()
+            self.__modules = dict()
+            self.__deltas = []
+            self.__index = None
+            for body in self.__bodies:
+                self.__records.update({x[0]: x for x in body.modules})
             return True
         except Exception as exc:
             self.__parse_exc = exc
-            self.__manifest = None
+            self.__bodies = None
+            self.__records = dict()
             self.__modules = dict()
             return False
 
+    @staticmethod
+    def __verify_delta(data: bytes, base_timestamp: int) -> DeltaRecord:
+        """
+        Parse a delta and check its signature.
+
+        Raises: ManifestDeltaError
+        """
+        try:
+            delta = parse_delta(data)
+        except ValueError as exc:
+            raise ManifestDeltaError('Invalid manifest delta: {}'.format(exc))
+        if delta.base_timestamp != base_timestamp:
+            raise ManifestDeltaError('Manifest delta for {} applied on {}'.format(
+                delta.base_timestamp, base_timestamp))
+        signed_size = DELTA_BODY.size + len(delta.signature)
+        pubkey = _signing_key(delta.signature_type)
+        chunks = [data[delta.iopos:delta.iopos + DELTA_BODY.size],
+                  data[delta.iopos + signed_size:delta.iopos + signed_size + delta.mod_count * MODULE_RECORD.size +
+                       delta.removed_count * NAME_HASH_SIZE]]
+        digest = _signed_digest(pubkey, chunks, delta.signature)
+        if not (_is_verified(digest) or ManifestManager.__verify_signature(delta, pubkey, chunks, digest)):
+            raise ManifestDeltaError('Invalid manifest delta signature')
+        return delta
+
+    def __apply_delta(self, data: bytes) -> None:
+        delta = self.__verify_delta(data, self.timestamp)
+        for record in delta.modules:
+            self.__records[record[0]] = record
+            self.__modules.pop(record[0], None)
+        for name_hash in delta.removed:
+            self.__records.pop(name_hash, None)
+            self.__modules.pop(name_hash, None)
+        self.__deltas.append(data)
+        self.timestamp = delta.timestamp
+
+    def __load_index_base(self, index: ManifestIndex) -> None:
+        """
+        Load the manifest and deltas the index was built from, the index is only used when they verify.
+
+        Raises: ImportError
+        """
+        data = Cache().get('manifest', metrics_tag='importer') or b''
+        deltas = Cache().get('manifest_deltas', metrics_tag='importer') or []
+        if manifest_digest(data, deltas) != index.digest:
+            bundle = get_bundle()
+            data, deltas = bundle.manifest if bundle else b'', []
+            if manifest_digest(data, deltas) != index.digest:
+                raise ImportError('The index was not built from the cached manifest')
+        try:
+            self.__bodies = parse_manifest(data)
+        except ValueError as exc:
+            raise ImportError('Invalid cached manifest: {}'.format(exc))
+        self.__data = data
+        if not self.verify():
+            raise ImportError('Invalid cached manifest signature')
+        timestamp = max([x.timestamp for x in self.__bodies] or [0])
+        for delta in deltas:
+            timestamp = self.__verify_delta(delta, timestamp).timestamp
+        if timestamp != index.timestamp:
+            raise ImportError('Cached manifest {} does not match the index {}'.format(timestamp, index.timestamp))
+        self.__deltas = list(deltas)
+
+    def __load_from_index(self):
+        index = ManifestIndex.open()
+        if index is None:
+            return False
+        try:
+            self.__load_index_base(index)
+        except ImportError as exc:
+            logging.debug("Manifest index is not usable: %s", exc)
+            self.__data = b''
+            self.__bodies = None
+            self.__deltas = []
+            return False
+        self.__index = index
+        self.__records = index
+        self.__modules = dict()
+        self.timestamp = index.timestamp
+        return True
+
+    def __save_index(self, expire_time: float):
+        if self.__index is None and expire_time > time.time():
+            write_index(list(self.__records.values()), self.timestamp, expire_time,
+                        manifest_digest(self.__data, self.__deltas))
+
     def __load_from_cache(self):
-        self.__data = Cache().get('manifest')
-        return self.__parse() and self.verify()
+        self.__data, expire_time = Cache().get('manifest', expire_time=True, metrics_tag='importer')
+        if not (self.__parse() and self.verify()):
+            return False
+        self.__set_timestamp()
+        cached = Cache().get_many(['manifest_deltas', _validators_key('manifest')], metrics_tag='importer')
+        try:
+            for delta in cached.get('manifest_deltas') or []:
+                self.__apply_delta(delta)
+        except ManifestDeltaError as exc:
+            logging.debug("Cached manifest deltas are not usable: %s", exc)
+            self.__bodies = None
+            self.__records = dict()
+            self.__modules = dict()
+            self.__deltas = []
+            self.timestamp = 0
+            return False
+        validators = cached.get(_validators_key('manifest'))
+        if validators is not None:
+            expire_time = validators['fresh_until']
+        self.__save_index(expire_time or time.time() + CACHE_SETTINGS.get('default_expiration'))
+        return True
+
+    def __load_from_bundle(self):
+        bundle = get_bundle()
+        if bundle is None:
+            return False
+        self.__data = bundle.manifest
+        if not (self.__parse() and self.verify()):
+            return False
+        self.__set_timestamp()
+        # Updates are fetched by the next refresh, until then the other processes map the bundle manifest
+        self.__save_index(time.time() + CACHE_SETTINGS.get('default_expiration'))
+        return True
+
+    def __set_timestamp(self):
+        self.timestamp = max([x.timestamp for x in self.__bodies] or [0])
+
+    def __load_from_server(self, delta: bool = False) -> bool:
+        """Load the manifest from the server, returns False when no newer manifest is available"""
+        params = {'cur': self.timestamp}
+        if delta:
+            params['delta'] = 1
+        req = req_sess.get(
+            'code_manifest',
+            params=params,
+            headers=_conditional_headers('manifest') if self.timestamp else None)
+        if req.status_code == 304:
+            validators = _revalidated('manifest', req.headers, 'manifest_deltas')
+            if validators:
+                self.__save_index(validators['fresh_until'])
+            return False
+        if req.status_code != 200:
+            raise ImportError('Error while loading manifest from the server')
+
+        if req.content.startswith(DELTA_MAGIC):
+            if not delta:
+                raise ImportError('Unexpected manifest delta')
+            if self.__index is not None:
+                # The mapped index is read-only
+                self.__records = dict(self.__records)
+                self.__index = None
+            self.__apply_delta(req.content)
+            validators = _cache_response('manifest', self.__data, req.headers)
+            if validators:
+                Cache().set('manifest_deltas', self.__deltas, expire=validators['expire'], tag='importer')
+                self.__save_index(validators['fresh_until'])
+            return True
+
+        self.__data = req.content
+        if not (self.__parse() and self.verify()):
+            return False
+        self.__set_timestamp()
+        validators = _cache_response('manifest', self.__data, req.headers)
+        if validators:
+            Cache().delete('manifest_deltas', metrics_tag='importer')
+            self.__save_index(validators['fresh_until'])
+        return True
 
     def load(self) -> None:
         """Loads the manifest"""
-        if self.__load_from_cache():
+        with self.__lock:
+            self.__load()
+
+    def __load(self) -> None:
+        if self.__load_from_index():
             return
+        if self.__load_from_cache():
+            if _is_fresh('manifest'):
+                return
+            # Usually a 304, the stale manifest is still used when the server is not reachable or sends garbage
+            manifest = self.copy()
+            try:
+                if manifest.refresh():
+                    self.__update(manifest)
+            except ImportError as exc:
+                logging.debug("Cannot revalidate the cached manifest: %s", exc)
+        elif not self.__load_from_bundle():
+            try:
+                self.__load_from_server()
+            except CommException as exc:
+                if not self.__data:
+                    raise ImportError('No manifest : {}'.format(exc))
 
-        try:
-            req = req_sess.get(
-                'code_manifest',
-                params={'cur': self.timestamp})
-            if req.status_code == 200:
-                self.__data = req.content
-                if self.__parse() and self.verify():
-                    cache_time = req.headers.get('Cache-Control')
-                    if cache_time and cache_time.startswith('max-age='):
-                        try:
-                            cache_time = int(cache_time[8:])
-                            if cache_time > 0:
-                                Cache().set('manifest', self.__data, expire=cache_time, tag='importer')
-                        except:
-                            pass
-            else:
-                raise ImportError('Error while loading manifest from the server')
-        except CommException as exc:
-            if not self.__data:
+        if not self.__bodies:
+            raise ImportError('Invalid manifest: {}'.format(self.__parse_exc))
+
+    def refresh(self) -> bool:
+        """Update the manifest from the server, using a delta when possible. Returns True when it changed"""
+        with self.__lock:
+            timestamp = self.timestamp
+            try:
+                try:
+                    delta = ((self.__bodies is not None or self.__index is not None) and
+                             len(self.__deltas) < settings.Config().get('IMPORTER_MAX_DELTAS', MAX_DELTAS))
+                    return self.__load_from_server(delta=delta) and self.timestamp != timestamp
+                except ManifestDeltaError as exc:
+                    logging.info("Cannot apply manifest delta, loading the full manifest: %s", exc)
+                    self.timestamp = timestamp
+                    return self.__load_from_server() and self.timestamp != timestamp
+            except CommException as exc:
                 raise ImportError('No manifest : {}'.format(exc))
 
-        if not self.__manifest:
-            raise ImportError('Invalid manifest: {}'.format(self.__parse_exc))
+    def __signed_data(self, manifest: ManifestBodyRecord):
+        """Get the (public key, signed chunks, digest) of a manifest body"""
+        start = manifest.iopos + MANIFEST_BODY.size + len(manifest.signature)
+        pubkey = _signing_key(manifest.signature_type)
+        chunks = [self.__data[manifest.iopos:manifest.iopos + MANIFEST_BODY.size],
+                  self.__data[start:start + manifest.mod_count * MODULE_RECORD.size]]
+        return pubkey, chunks, _signed_digest(pubkey, chunks, manifest.signature)
 
-    def __verify_signature(self, manifest: Manifest.ManifestBody, pubkey: str) -> bool:
-        key = RSA.importKey(pubkey)
-        signature = manifest.signature
-        hashalgo = SHA512.new()
-        hashalgo.update(self.__data[manifest.iopos:manifest.iopos + 12])
-        start = manifest.iopos + 12 + len(signature)
-        hashalgo.update(self.__data[start:start + manifest.mod_count * 97])
-        verifier = PKCS1_PSS.new(key)
-        return verifier.verify(hashalgo, signature)
+    @staticmethod
+    def __verify_signature(manifest, pubkey: Optional[str], chunks, digest: bytes) -> bool:
+        """Check the signature of a manifest body or delta, and remember it"""
+        if not verify_signature(pubkey, chunks, manifest.signature, manifest.signature_type):
+            return False
+        with _verified_lock:
+            _verified_bodies[digest] = True
+            while len(_verified_bodies) > VERIFIED_CACHE_SIZE:
+                _verified_bodies.popitem(last=False)
+        return True
 
     def verify(self) -> bool:
         """Verify the manifest integrity"""
-        if not self.__data:
-            return False
-        if not all([self.__verify_signature(x, settings.Config().SIGN_PUBKEY) for x in self.__manifest.manifests]):
+        if not self.__data or not self.__bodies:
             return False
+
+        pending = []
+        for body in self.__bodies:
+            pubkey, chunks, digest = self.__signed_data(body)
+            if _is_verified(digest):
+                continue
+            pending.append((body, pubkey, chunks, digest))
+
+        workers = min(len(pending), settings.Config().get('IMPORTER_VERIFY_WORKERS', 4), os.cpu_count() or 1)
+        if workers <= 1:
+            return all(self.__verify_signature(*x) for x in pending)
+
+        # Checks are mostly spent in the crypto libraries outside of the GIL, stop at the first invalid body
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.__verify_signature, *x) for x in pending]
+            for future in as_completed(futures):
+                if not future.result():
+                    for other in futures:
+                        other.cancel()
+                    return False
         return True
 
     def get(self, name_hash: bytes) -> Optional[Module]:
         """Get a Module"""
-        if self.__manifest is None:
-            try:
-                self.load()
-            except:
+        if self.__bodies is None and self.__index is None:
+            with self.__lock:
+                if self.__bodies is None and self.__index is None:
+                    try:
+                        self.load()
+                    except:
+                        return None
+        mod = self.__modules.get(name_hash)
+        if mod is None:
+            record = self.__records.get(name_hash)
+            if record is None:
                 return None
-        return self.__modules.get(name_hash)
+            mod = self.__modules.setdefault(name_hash, Module(ModuleRecord._make(record)))
+        return mod
+
+    def fetch(self, name_hashes) -> int:
+        """Download the missing modules using as few code packs as possible, the import path fetches one at a time"""
+        modules = [self.get(x) for x in name_hashes]
+        # Binary modules are streamed to disk when imported, a pack would hold them in memory
+        missing = [x for x in modules if x and not x.is_bin and self.__is_missing(x)]
+        pack_size = settings.Config().get('IMPORTER_PACK_SIZE', 64)
+        count = 0
+        for i in range(0, len(missing), pack_size):
+            count += self.__fetch_pack(missing[i:i + pack_size])
+        return count
+
+    @staticmethod
+    def __is_missing(mod: Module) -> bool:
+        return (mod.no_cache or mod.cache_key not in Cache()) and not mod.in_bundle
+
+    def __fetch_pack(self, modules) -> int:
+        # The modules being downloaded by other threads are left to them
+        held = [x.name_hash for x in modules if _module_locks.acquire(x.name_hash, blocking=False)]
+        try:
+            return self.__fetch_modules([x for x in modules if x.name_hash in held and self.__is_missing(x)])
+        finally:
+            for name_hash in held:
+                _module_locks.release(name_hash)
+
+    def __fetch_modules(self, modules) -> int:
+        if not modules:
+            return 0
+        wanted = {x.name_hash: x for x in modules}
+        try:
+            with profile_phase('fetch') as phase:
+                req = req_sess.get(
+                    'code_pkg',
+                    params={'id': [binascii.hexlify(x) for x in wanted], 'pack': 1})
+                phase.size = len(req.content)
+            if req.status_code != 200:
+                return 0
+            entries = list(_split_pack(req.content))
+        except (CommException, ImportError, struct.error) as exc:
+            logging.debug("Error while loading code pack: %s", exc)
+            return 0
+
+        count = 0
+        cached = dict()
+        for name_hash, data in entries:
+            mod = wanted.pop(name_hash, None)
+            if not mod:
+                continue
+            if not mod.set_data(data):
+                logging.warning("Module %s is corrupted in code pack", binascii.hexlify(name_hash))
+                continue
+            if not mod.no_cache:
+                cached[mod.cache_key] = data
+            count += 1
+
+        # Each module of the pack is cached for the max-age of the pack, without validators
+        max_age = _max_age(req.headers)
+        if cached and max_age > 0:
+            with Cache().transact():
+                Cache().set_many(cached, expire=max_age, tag='importer')
+                Cache().delete_many([_validators_key(x) for x in cached], metrics_tag='importer')
+        return count
 
 
 class EPCLoader(InspectLoader):
@@ -210,53 +859,137 @@ class EPCLoader(InspectLoader):
 
     def __init__(self):
         self.manifest = None
+        self.__trace = None  # type: Optional[List[str]]
+        self.__trace_name = None
+        self.__misses = set()  # Names known to be absent from the current manifest
+        self.__trace_lock = Lock()
         self._get_manifest()
+        refresh_delay = settings.Config().get('IMPORTER_REFRESH_DELAY', 300)
+        if refresh_delay:
+            Thread(target=self.__refresh_manifest_loop, args=(refresh_delay,), daemon=True).start()
 
     def _get_manifest(self):
         self.manifest = ManifestManager()
         while True:  # Ensure the manifest is loaded
             try:
-                self.manifest.load()
-                if self.manifest.verify():
+                with profile_phase('manifest'):
+                    self.manifest.load()
+                    verified = self.manifest.verify()
+                if verified:
                     break
                 else:
                     # Clean the importer cache when integrity is broken
                     logging.error("Manifest integrity error, purging cache")
                     Cache().evict('importer')
+                    remove_index()
                     shutil.rmtree(settings.Config().BINCACHE_DIR, ignore_errors=True)
             except ImportError as e:
                 logging.debug("Error while loading manifest: %s", e)
             time.sleep(settings.Config().get('IMPORTER_SLEEP', 5))
 
+    def _refresh_manifest(self) -> bool:
+        """Swap the manifest in use with a newer one from the server"""
+        manifest = self.manifest.copy()
+        try:
+            if not manifest.refresh():
+                return False
+        except ImportError as e:
+            logging.debug("Error while refreshing manifest: %s", e)
+            return False
+        self.manifest = manifest
+        self.__misses = set()
+        logging.info("Manifest updated (%d)", manifest.timestamp)
+        return True
+
+    def __refresh_manifest_loop(self, delay: int):
+        while True:
+            time.sleep(delay)
+            self._refresh_manifest()
+
     def _get_module(self, fullname) -> Module:
-        name_hash = sha256(fullname.encode('ascii'))
-        mod = self.manifest.get(name_hash.digest())
+        mod = self.manifest.get(_name_hash(fullname))
         if not mod:
             raise ImportError('Unknown module : {}'.format(fullname))
         return mod
 
+    @staticmethod
+    def __binmodule_key(mod: Module) -> str:
+        return 'binmodule_{}'.format(binascii.hexlify(mod.code_hash).decode('ascii'))
+
+    @classmethod
+    def __check_binmodule(cls, filename: str, mod: Module) -> bool:
+        """Tell if a binary module has already been written and left untouched"""
+        expected = Cache().get(cls.__binmodule_key(mod), metrics_tag='importer')
+        if not expected:
+            return False
+        try:
+            current = _file_mac(filename, mod.code_hash)
+        except OSError:
+            return False
+        return current is not None and hmac.compare_digest(current, expected)
+
+    @staticmethod
+    def __clean_binmodules(name: str, filename: str) -> None:
+        """Remove the other versions of a binary module"""
+        bincache = settings.Config().BINCACHE_DIR
+        pattern = re.compile(r'{}(\.[0-9a-f]{{16}})?\.{}$'.format(
+            re.escape(name), re.escape(settings.Config().BINARY_MODULE_EXT)))
+        for entry in os.listdir(bincache):
+            path = os.path.join(bincache, entry)
+            if pattern.match(entry) and path != filename:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # When a module is loaded (Windows), it cannot be removed
+                    pass
+
     def _write_binmodule(self, name: str, mod: Module) -> str:
         if not mod.is_bin:
             raise ImportError("Try to write a non-binary module")
-        os.makedirs(settings.Config().BINCACHE_DIR, exist_ok=True)
-        filename = os.path.join(settings.Config().BINCACHE_DIR,
-                                '{}.{}'.format(name, settings.Config().BINARY_MODULE_EXT))
+        bincache = settings.Config().BINCACHE_DIR
+        os.makedirs(bincache, exist_ok=True)
+        filename = os.path.join(bincache, '{}.{}.{}'.format(
+            name, binascii.hexlify(mod.code_hash[:8]).decode('ascii'), settings.Config().BINARY_MODULE_EXT))
+        with _module_locks.hold(mod.name_hash):
+            return self.__write_binmodule(name, mod, filename)
+
+    def __write_binmodule(self, name: str, mod: Module, filename: str) -> str:
+        if self.__check_binmodule(filename, mod):
+            return filename
+
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp-')
         try:
-            with open(filename, 'wb') as ofile:
-                ofile.write(mod.get_code())
-        except PermissionError:
-            # When a module is already loaded, the write will fail
-            pass
+            # The decrypted code is only renamed in place once its hash has been checked
+            with os.fdopen(fd, 'wb') as ofile:
+                mod.write_code(ofile)
+            mac = _file_mac(tmpname, mod.code_hash)
+            try:
+                os.replace(tmpname, filename)
+            except OSError:
+                # A loaded module cannot be replaced (Windows), it is used when it holds the same code
+                current = _file_mac(filename, mod.code_hash) if mac else None
+                if current is None or not hmac.compare_digest(current, mac):
+                    raise
+        except OSError as exc:
+            raise ImportError('Cannot write binary module {} : {}'.format(name, exc))
+        finally:
+            if os.path.exists(tmpname):
+                try:
+                    os.remove(tmpname)
+                except OSError:
+                    pass
+
+        if mac:
+            Cache().set(self.__binmodule_key(mod), mac, expire=SealedCodeStore().expire, tag='importer')
+        self.__clean_binmodules(name, filename)
         return filename
 
     def create_module(self, spec: ModuleSpec) -> Optional[Module]:
         mod = self._get_module(spec.name)
         if not mod.is_bin:
             return None
-        try:
+        with profile_module(spec.name):
             filename = self._write_binmodule(spec.name, mod)
-        except ImportError:
-            return None
         spec.origin = filename
         module = _imp.create_dynamic(spec)
         return module
@@ -268,12 +1001,21 @@ class EPCLoader(InspectLoader):
         if mod.is_bin:
             return b''
         try:
-            code = mod.get_code()
+            return self._load_code(mod)
         except ImportError:
             logging.exception("Error while importing module")
             return b''
 
-        return marshal.loads(code)
+    def exec_module(self, module) -> None:
+        """Execute the module, recording the time spent in each phase of the import when profiling"""
+        if get_profiler() is None:
+            return super().exec_module(module)
+        with profile_module(module.__name__):
+            code = self.get_code(module.__name__)
+            if code is None:
+                raise ImportError('cannot load module {!r} when get_code() returns None'.format(module.__name__))
+            with profile_phase('exec'):
+                exec(code, module.__dict__)
 
     def get_source(self, fullname) -> None:
         return None
@@ -282,13 +1024,122 @@ class EPCLoader(InspectLoader):
         mod = self._get_module(fullname)
         return mod.is_pkg
 
+    @staticmethod
+    def _load_code(mod: Module):
+        """Get the code object of a module, decrypting it only when not already cached"""
+        code = CodeCache().get(mod.code_hash)
+        if code is not None:
+            return code
+        with _module_locks.hold(mod.name_hash):
+            # Loaded by another thread while waiting
+            code = CodeCache().get(mod.code_hash)
+            if code is not None:
+                return code
+            return EPCLoader.__load_code(mod)
+
+    @staticmethod
+    def __load_code(mod: Module):
+        with profile_phase('cache'):
+            data = SharedCodeArena().get(mod.code_hash)
+            if data is None:
+                data = SealedCodeStore().get(mod.code_hash)
+        stored = data is not None
+        if not stored:
+            data = mod.get_code()
+        try:
+            with profile_phase('unmarshal', len(data)):
+                code = marshal.loads(data)
+        except (EOFError, ValueError, TypeError) as exc:
+            raise ImportError('Invalid code for module {} : {}'.format(
+                binascii.hexlify(mod.name_hash), exc))
+        if not stored and not mod.no_cache:
+            SealedCodeStore().set(mod.code_hash, data)
+        CodeCache().set(mod.code_hash, code, len(data))
+        return code
+
+    @classmethod
+    def __decrypt(cls, mod: Module) -> None:
+        try:
+            cls._load_code(mod)
+        except ImportError:
+            pass
+
+    def prefetch(self, fullnames) -> int:
+        """
+        Download in bulk and decrypt several modules before they are imported.
+        The manifest only holds name hashes: the modules of an app are known from the trace of a previous run
+        (see get_trace), without one each module is still downloaded on its own request when imported.
+        """
+        name_hashes = [_name_hash(x) for x in fullnames]
+        count = self.manifest.fetch(name_hashes)
+        modules = [x for x in (self.manifest.get(y) for y in name_hashes) if x and not x.is_bin]
+        if modules:
+            with ThreadPoolExecutor(max_workers=settings.Config().get('IMPORTER_PREFETCH_WORKERS', 4)) as pool:
+                list(pool.map(self.__decrypt, modules))
+        return count
+
+    def publish(self, fullnames) -> int:
+        """Publish the decrypted code of several modules to the shared code arena, for the workers to map"""
+        arena = SharedCodeArena()
+        if not arena.enabled:
+            return 0
+        self.manifest.fetch([_name_hash(x) for x in fullnames])
+        entries = dict()
+        for fullname in fullnames:
+            mod = self.manifest.get(_name_hash(fullname))
+            if not mod or mod.is_bin or mod.no_cache or mod.code_hash in arena:
+                continue
+            data = SealedCodeStore().get(mod.code_hash)
+            if data is None:
+                try:
+                    data = mod.get_code()
+                except ImportError:
+                    continue
+            entries[mod.code_hash] = data
+        return arena.publish(entries)
+
+    def publish_app(self, name: str) -> int:
+        """Publish the modules imported during the last recorded run of an app"""
+        fullnames = ['apps', 'apps.{}'.format(name)]
+        fullnames += [x for x in self.get_trace(name) if x not in fullnames]
+        return self.publish(fullnames)
+
+    def __trace_key(self, name: str) -> str:
+        return 'import_trace_{}_{}'.format(name, self.manifest.timestamp)
+
+    def get_trace(self, name: str) -> List[str]:
+        """Get the modules imported during the last recorded run of an app"""
+        return Cache().get(self.__trace_key(name), metrics_tag='importer') or []
+
+    def start_trace(self, name: str) -> None:
+        """Record the modules imported from now on"""
+        self.__trace_name = name
+        self.__trace = []
+
+    def stop_trace(self) -> None:
+        """Stop recording and keep the trace for the next runs"""
+        if self.__trace is None:
+            return
+        trace, self.__trace = self.__trace, None
+        if trace and trace != self.get_trace(self.__trace_name):
+            Cache().set(self.__trace_key(self.__trace_name), trace, tag='importer')
+
     def get_mod(self, fullname: str) -> Optional[Module]:
         """Return the module"""
-        mod_hash = sha256(fullname.encode('ascii'))
-        self._get_manifest()
+        misses = self.__misses
+        if fullname in misses:
+            return None
         if not self.manifest:
             raise ImportError('No manifest')
-        return self.manifest.get(mod_hash.digest())
+        mod = self.manifest.get(_name_hash(fullname))
+        trace = self.__trace
+        if not mod:
+            misses.add(fullname)
+        elif trace is not None:
+            with self.__trace_lock:
+                if fullname not in trace:
+                    trace.append(fullname)
+        return mod
 
 
 class EPCMetaFinder(MetaPathFinder):
@@ -303,6 +1154,11 @@ class EPCMetaFinder(MetaPathFinder):
         else:
             self.__loader = EPCLoader()
 
+    @property
+    def loader(self) -> EPCLoader:
+        """Loader used by the finder"""
+        return self.__loader
+
     def find_spec(self, fullname: str, path: str, target=None) -> Optional[ModuleSpec]:
         """
         Method for finding a spec for the specified module.
@@ -314,18 +1170,19 @@ class EPCMetaFinder(MetaPathFinder):
         mod = self.__loader.get_mod(fullname)
         if not mod:
             return None
-        if mod.is_bin:
-            return ModuleSpec(
-                "%s" % fullname,
-                self.__loader,
-                origin="epc",
-                is_package=self.__loader.is_package(fullname))
-        else:
-            return ModuleSpec(
-                "%s" % fullname,
-                self.__loader,
-                origin="epc",
-                is_package=self.__loader.is_package(fullname))
+        return ModuleSpec(
+            "%s" % fullname,
+            self.__loader,
+            origin="epc",
+            is_package=mod.is_pkg)
+
+
+def get_loader() -> Optional[EPCLoader]:
+    """Get the loader of the installed importer"""
+    for finder in sys.meta_path:
+        if isinstance(finder, EPCMetaFinder):
+            return finder.loader
+    return None
 
 
 def setup_importer() -> bool:
@@ -0,0 +1,207 @@
+"""
+importprofile.py : Timings of the importer phases
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+from time import perf_counter
+from typing import List, Optional
+
+import epc.common.settings as settings
+
+# Phases of an import, 'exec' includes the nested imports
+PHASES = ['manifest', 'fetch', 'cache', 'hash', 'decrypt', 'unmarshal', 'exec']
+
+
+class Frame(object):
+    """Timings of a module, nested by import chain"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.phases = OrderedDict()  # name -> [seconds, bytes, count]
+        self.children = OrderedDict()  # name -> Frame
+        self.__lock = threading.Lock()
+
+    def child(self, name: str) -> 'Frame':
+        with self.__lock:
+            frame = self.children.get(name)
+            if frame is None:
+                frame = self.children[name] = Frame(name)
+            return frame
+
+    def add(self, phase: str, elapsed: float, size: int) -> None:
+        with self.__lock:
+            stats = self.phases.get(phase)
+            if stats is None:
+                stats = self.phases[phase] = [0.0, 0, 0]
+            stats[0] += elapsed
+            stats[1] += size
+            stats[2] += 1
+
+    def to_dict(self) -> dict:
+        """JSON serializable timings, in milliseconds"""
+        return dict(
+            name=self.name,
+            count=self.count,
+            total_ms=self.total * 1000,
+            phases={x: dict(ms=y[0] * 1000, bytes=y[1], count=y[2]) for x, y in self.phases.items()},
+            children=[x.to_dict() for x in self.children.values()]
+        )
+
+    def collapsed(self, prefix: str = '') -> List[str]:
+        """Lines of the collapsed stack format used by flame graph tools, in microseconds"""
+        path = '{};{}'.format(prefix, self.name) if prefix else self.name
+        children = sum(x.total for x in self.children.values())
+        lines = []
+        for phase, stats in self.phases.items():
+            elapsed = stats[0] - children if phase == 'exec' else stats[0]
+            if elapsed > 0:
+                lines.append('{};[{}] {}'.format(path, phase, int(elapsed * 1e6)))
+        for frame in self.children.values():
+            lines += frame.collapsed(path)
+        return lines
+
+
+class _NullContext(object):
+    """Context used when profiling is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL = _NullContext()
+
+
+class _Phase(object):
+    __slots__ = ('frame', 'name', 'size', 'start')
+
+    def __init__(self, frame: Frame, name: str, size: int):
+        self.frame = frame
+        self.name = name
+        self.size = size
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.frame.add(self.name, perf_counter() - self.start, self.size)
+        return False
+
+
+class _Module(object):
+    __slots__ = ('stack', 'name', 'frame', 'start')
+
+    def __init__(self, stack: list, name: str):
+        self.stack = stack
+        self.name = name
+
+    def __enter__(self):
+        self.frame = self.stack[-1].child(self.name)
+        self.stack.append(self.frame)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.frame.total += perf_counter() - self.start
+        self.frame.count += 1
+        self.stack.pop()
+        return False
+
+
+class ImportProfiler(object):
+    """Record the time and bytes spent in each phase of the imports"""
+
+    def __init__(self, name: str = 'worker'):
+        self.root = Frame(name)
+        self.__start = perf_counter()
+        self.__local = threading.local()
+
+    def __stack(self) -> list:
+        stack = getattr(self.__local, 'stack', None)
+        if stack is None:
+            stack = self.__local.stack = [self.root]
+        return stack
+
+    def module(self, fullname: str) -> _Module:
+        """Context of the import of a module, nested in the module being imported by this thread"""
+        return _Module(self.__stack(), fullname)
+
+    def phase(self, name: str, size: int = 0) -> _Phase:
+        """Context of a phase of the module being imported by this thread"""
+        return _Phase(self.__stack()[-1], name, size)
+
+    def export(self, directory: str, name: str, extra: Optional[dict] = None) -> Optional[str]:
+        """Write the profile as JSON and collapsed stacks, returns the path of the JSON file"""
+        self.root.total = perf_counter() - self.__start
+        basename = os.path.join(directory, '{}-{}'.format(name, os.getpid()))
+        profile = self.root.to_dict()
+        if extra:
+            profile.update(extra)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(basename + '.json', 'w') as ofile:
+                json.dump(profile, ofile, indent=1)
+            with open(basename + '.folded', 'w') as ofile:
+                ofile.write('\n'.join(self.root.collapsed()))
+                ofile.write('\n')
+        except OSError:
+            return None
+        return basename + '.json'
+
+
+_profiler = None  # type: ImportProfiler
+_profiler_checked = False
+
+
+def get_profiler() -> Optional[ImportProfiler]:
+    """Get the profiler of this process, None unless IMPORTER_PROFILE is set"""
+    global _profiler, _profiler_checked
+    if not _profiler_checked:
+        _profiler_checked = True
+        if settings.Config().get('IMPORTER_PROFILE'):
+            _profiler = ImportProfiler()
+    return _profiler
+
+
+def get_profile_dir() -> str:
+    """Directory of the exported profiles, IMPORTER_PROFILE may be a path"""
+    directory = settings.Config().get('IMPORTER_PROFILE')
+    if not isinstance(directory, str):
+        directory = os.path.join(settings.Config().CACHE_DIR, 'profiles')
+    return directory
+
+
+def profile_phase(name: str, size: int = 0):
+    """Time a phase of the current import when profiling"""
+    profiler = _profiler if _profiler_checked else get_profiler()
+    return profiler.phase(name, size) if profiler else _NULL
+
+
+def profile_module(fullname: str):
+    """Time the import of a module when profiling"""
+    profiler = _profiler if _profiler_checked else get_profiler()
+    return profiler.module(fullname) if profiler else _NULL
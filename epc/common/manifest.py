@@ -20,10 +20,90 @@ along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 import array
 import struct
 import zlib
+from collections import namedtuple
 from enum import Enum
 
 from epc.common.kaitaistruct import KaitaiStruct, KaitaiStream, BytesIO
 
+# Fast path: same layouts as the Kaitai structures below, unpacked with precompiled structs
+MANIFEST_MAGIC = b'SONEMANI'
+DELTA_MAGIC = b'SONEDELT'
+MANIFEST_HEADER = struct.Struct('<8sH')  # magic, count
+MANIFEST_BODY = struct.Struct('<BBHQ')  # version, signature_type, mod_count, timestamp
+DELTA_BODY = struct.Struct('<BBHHQQ')  # version, signature_type, mod_count, removed_count, base_timestamp, timestamp
+SIGNATURE_SIZE = 512
+MODULE_RECORD = struct.Struct('<32sB32s32s')  # name_hash, flags, key, code_hash
+NAME_HASH_SIZE = 32
+
+ModuleRecord = namedtuple('ModuleRecord', ['name_hash', 'flags', 'key', 'code_hash'])
+ManifestBodyRecord = namedtuple('ManifestBodyRecord', [
+    'iopos', 'version', 'signature_type', 'mod_count', 'timestamp', 'signature', 'modules'])
+DeltaRecord = namedtuple('DeltaRecord', [
+    'iopos', 'version', 'signature_type', 'mod_count', 'removed_count', 'base_timestamp', 'timestamp',
+    'signature', 'modules', 'removed'])
+
+
+def _read_modules(view: memoryview, offset: int, count: int) -> list:
+    end = offset + count * MODULE_RECORD.size
+    if end > len(view):
+        raise ValueError('Truncated module records')
+    return list(MODULE_RECORD.iter_unpack(view[offset:end]))
+
+
+def parse_manifest(data: bytes) -> list:
+    """
+    Parse a manifest without going through Kaitai.
+    Returns the bodies, their modules being (name_hash, flags, key, code_hash) tuples.
+
+    Raises: ValueError
+    """
+    view = memoryview(data)
+    try:
+        magic, count = MANIFEST_HEADER.unpack_from(view)
+        if magic != MANIFEST_MAGIC:
+            raise ValueError('Invalid manifest magic')
+        bodies = []
+        offset = MANIFEST_HEADER.size
+        for _ in range(count):
+            iopos = offset
+            version, signature_type, mod_count, timestamp = MANIFEST_BODY.unpack_from(view, offset)
+            offset += MANIFEST_BODY.size
+            signature = bytes(view[offset:offset + SIGNATURE_SIZE])
+            offset += SIGNATURE_SIZE
+            modules = _read_modules(view, offset, mod_count)
+            offset += mod_count * MODULE_RECORD.size
+            bodies.append(ManifestBodyRecord(
+                iopos, version, signature_type, mod_count, timestamp, signature, modules))
+        return bodies
+    except struct.error as exc:
+        raise ValueError('Truncated manifest: {}'.format(exc))
+
+
+def parse_delta(data: bytes) -> DeltaRecord:
+    """
+    Parse a manifest delta without going through Kaitai.
+
+    Raises: ValueError
+    """
+    view = memoryview(data)
+    if bytes(view[:len(DELTA_MAGIC)]) != DELTA_MAGIC:
+        raise ValueError('Invalid manifest delta magic')
+    try:
+        iopos = offset = len(DELTA_MAGIC)
+        fields = DELTA_BODY.unpack_from(view, offset)
+        offset += DELTA_BODY.size
+        signature = bytes(view[offset:offset + SIGNATURE_SIZE])
+        offset += SIGNATURE_SIZE
+        modules = _read_modules(view, offset, fields[2])
+        offset += fields[2] * MODULE_RECORD.size
+        end = offset + fields[3] * NAME_HASH_SIZE
+        if end > len(view):
+            raise ValueError('Truncated removed modules')
+        removed = [bytes(view[x:x + NAME_HASH_SIZE]) for x in range(offset, end, NAME_HASH_SIZE)]
+        return DeltaRecord(iopos, *fields, signature=signature, modules=modules, removed=removed)
+    except struct.error as exc:
+        raise ValueError('Truncated manifest delta: {}'.format(exc))
+
 
 class Manifest(KaitaiStruct):
     def __init__(self, _io, _parent=None, _root=None):
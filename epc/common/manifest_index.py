@@ -0,0 +1,165 @@
+"""
+manifest_index.py : Compact manifest index shared by the processes of the host
+
+This file is part of EPControl.
+
+Copyright (C) 2016  Jean-Baptiste Galet & Timothe Aeberhardt
+
+EPControl is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+EPControl is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hmac
+import mmap
+import os
+import struct
+import tempfile
+import time
+from collections.abc import Mapping
+from hashlib import sha256
+from typing import Optional
+
+import epc.common.settings as settings
+from epc.common.codecache import get_host_key
+from epc.common.manifest import MODULE_RECORD, NAME_HASH_SIZE
+
+INDEX_MAGIC = b'EPCMIDX2'
+INDEX_HEADER = struct.Struct('<8sQdI32s')  # magic, timestamp, expire_time, count, manifest digest
+INDEX_MAC_SIZE = 32
+INDEX_DATA = INDEX_HEADER.size + INDEX_MAC_SIZE
+
+
+def get_index_path() -> Optional[str]:
+    """Get the path of the manifest index, None if disabled"""
+    return settings.Config().get('IMPORTER_MANIFEST_INDEX',
+                                 os.path.join(settings.Config().CACHE_DIR, 'manifest.idx'))
+
+
+def manifest_digest(data: bytes, deltas) -> bytes:
+    """Digest of the signed manifest and deltas an index is built from"""
+    hashalgo = sha256(data)
+    for delta in deltas:
+        hashalgo.update(delta)
+    return hashalgo.digest()
+
+
+def _mac(key: bytes, header, records) -> bytes:
+    mac = hmac.new(key[32:], header, sha256)
+    mac.update(records)
+    return mac.digest()
+
+
+def write_index(records, timestamp: int, expire_time: float, digest: bytes) -> bool:
+    """
+    Persist verified module records, sorted by name_hash, for the other processes to map.
+    The index is bound to the manifest_digest of the cached manifest, sealed with the host key and replaced atomically.
+    """
+    filename = get_index_path()
+    key = get_host_key()
+    if not filename or not key:
+        return False
+    header = INDEX_HEADER.pack(INDEX_MAGIC, timestamp, expire_time, len(records), digest)
+    data = b''.join(MODULE_RECORD.pack(*x) for x in sorted(records, key=lambda x: x[0]))
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(fd, 'wb') as ofile:
+            ofile.write(header)
+            ofile.write(_mac(key, header, data))
+            ofile.write(data)
+        os.replace(tmpname, filename)
+    except OSError:
+        # The index may be mapped by another process (Windows)
+        try:
+            os.remove(tmpname)
+        except (OSError, UnboundLocalError):
+            pass
+        return False
+    return True
+
+
+def remove_index() -> None:
+    """Remove the manifest index"""
+    try:
+        os.remove(get_index_path())
+    except (OSError, TypeError):
+        pass
+
+
+class ManifestIndex(Mapping):
+    """
+    Read-only mapping name_hash -> (name_hash, flags, key, code_hash) over a memory-mapped index.
+    Lookups are binary searches in the sorted fixed-width records.
+    The index is only trusted once its digest matches a verified manifest.
+    """
+
+    def __init__(self, mapped: mmap.mmap, timestamp: int, count: int, digest: bytes):
+        self.__map = mapped
+        self.timestamp = timestamp
+        self.digest = digest
+        self.__count = count
+
+    @classmethod
+    def open(cls) -> Optional['ManifestIndex']:
+        """Map the index, None if it is missing, expired or has been tampered with"""
+        filename = get_index_path()
+        key = get_host_key()
+        if not filename or not key:
+            return None
+        try:
+            with open(filename, 'rb') as ifile:
+                mapped = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, timestamp, expire_time, count, digest = INDEX_HEADER.unpack_from(mapped)
+        except struct.error:
+            mapped.close()
+            return None
+        size = INDEX_DATA + count * MODULE_RECORD.size
+        if magic != INDEX_MAGIC or expire_time < time.time() or len(mapped) != size or not hmac.compare_digest(
+                mapped[INDEX_HEADER.size:INDEX_DATA],
+                _mac(key, mapped[:INDEX_HEADER.size], memoryview(mapped)[INDEX_DATA:])):
+            mapped.close()
+            return None
+        return cls(mapped, timestamp, count, digest)
+
+    def __find(self, name_hash: bytes) -> int:
+        low, high = 0, self.__count
+        while low < high:
+            mid = (low + high) // 2
+            offset = INDEX_DATA + mid * MODULE_RECORD.size
+            current = self.__map[offset:offset + NAME_HASH_SIZE]
+            if current < name_hash:
+                low = mid + 1
+            elif current > name_hash:
+                high = mid
+            else:
+                return offset
+        return -1
+
+    def __getitem__(self, name_hash: bytes):
+        offset = self.__find(name_hash)
+        if offset < 0:
+            raise KeyError(name_hash)
+        return MODULE_RECORD.unpack_from(self.__map, offset)
+
+    def __iter__(self):
+        for i in range(self.__count):
+            offset = INDEX_DATA + i * MODULE_RECORD.size
+            yield self.__map[offset:offset + NAME_HASH_SIZE]
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def copy(self) -> 'ManifestIndex':
+        """The index is immutable"""
+        return self
@@ -24,7 +24,7 @@ import time
 from abc import ABCMeta, abstractmethod
 from datetime import timedelta
 from threading import Thread
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 from typing import Tuple
 
 import arrow
@@ -153,13 +153,26 @@ class Task(metaclass=ABCMeta):
             return
 
         if self.__cur_config and self.__cur_config.get('task_id'):
-            Cache().set('task_lastrun_{task_id}'.format(**self.__cur_config), arrow.utcnow().timestamp, tag='scheduler')
+            Cache().set(self.last_run_key(self.__cur_config), arrow.utcnow().timestamp, tag='scheduler', retry=True)
 
-    def get_last_run(self, config: dict, default=None):
+    @staticmethod
+    def last_run_key(config: dict) -> Optional[str]:
+        """Get the cache key of the last run of a configuration"""
         if not config.get('task_id'):
+            return None
+        return 'task_lastrun_{task_id}'.format(**config)
+
+    def last_run_keys(self) -> List[str]:
+        """Get the cache keys of the last runs of all the configurations"""
+        return [x for x in (self.last_run_key(y) for y in self.data['configs']) if x]
+
+    def get_last_run(self, config: dict, default=None, last_runs: dict = None):
+        """Get the last run of a configuration, from last_runs when read in bulk with Cache().get_many"""
+        key = self.last_run_key(config)
+        if not key:
             return default
 
-        last_run = Cache().get('task_lastrun_{task_id}'.format(**config))
+        last_run = last_runs.get(key) if last_runs is not None else Cache().get(key, metrics_tag='scheduler')
         if not last_run:
             return default
 
@@ -173,7 +186,7 @@ class Task(metaclass=ABCMeta):
         #    return False
         return True
 
-    def can_start(self, config: dict) -> bool:
+    def can_start(self, config: dict, last_runs: dict = None) -> bool:
         """Tell if the task _CAN_ start"""
         if self.is_running():
             return False
@@ -184,13 +197,14 @@ class Task(metaclass=ABCMeta):
         # Tasks with no specific schedule run immediately
         if not schedule or schedule.get('type') == 'force':
             return True
-        elif schedule.get('type') == 'runonce' and not self.get_last_run(config):
+        elif schedule.get('type') == 'runonce' and not self.get_last_run(config, last_runs=last_runs):
             return True
         else:
             now = arrow.utcnow()
             if schedule.get('type') == 'crontab':
                 crontab = Crontab(schedule.get('value1'), bool(schedule.get('value2', False)))
-                next = crontab.next(arrow.get(self.get_last_run(config, arrow.utcnow().timestamp)))
+                last_run = self.get_last_run(config, arrow.utcnow().timestamp, last_runs=last_runs)
+                next = crontab.next(arrow.get(last_run))
                 if now < next:
                     return False
                 return True
@@ -212,20 +226,25 @@ class Task(metaclass=ABCMeta):
                 delta = PERIODS.get(period)
                 if not delta:
                     return False
-                if not self.get_last_run(config):
+                if not self.get_last_run(config, last_runs=last_runs):
                     return True
-                return arrow.get(self.get_last_run(config)) + delta < now
+                return arrow.get(self.get_last_run(config, last_runs=last_runs)) + delta < now
         return False
 
-    def status_report(self) -> dict:
+    def status_report(self, last_runs: dict = None) -> dict:
+        if last_runs is None:
+            last_runs = Cache().get_many(self.last_run_keys(), metrics_tag='scheduler')
         return dict(
             status=self.is_running(),
-            last_run={config.get('task_id'): self.get_last_run(config) for config in self.data['configs']}
+            last_run={config.get('task_id'): self.get_last_run(config, last_runs=last_runs)
+                      for config in self.data['configs']}
         )
 
-    def get_active_config(self) -> Optional[dict]:
+    def get_active_config(self, last_runs: dict = None) -> Optional[dict]:
+        if last_runs is None:
+            last_runs = Cache().get_many(self.last_run_keys(), metrics_tag='scheduler')
         for config in self.data['configs']:  # type: dict
-            if self.can_start(config):
+            if self.can_start(config, last_runs):
                 return {k: v for k, v in config.items() if not k.startswith('_')}
         return None
 
@@ -275,7 +294,7 @@ class Scheduler(metaclass=ABCMeta):
     def handle_rsp_active(self, value):
         """Activate tasks"""
         # Put the recieved data in cache
-        Cache().set('tasks', value, tag='scheduler')
+        Cache().set('tasks', value, tag='scheduler', retry=True)
         self.__create_tasks(value)
 
     def handle_rsp_stop(self, value):
@@ -289,10 +308,10 @@ class Scheduler(metaclass=ABCMeta):
                     self.stopped_tasks[stop_item] = task
 
                 # Remove from cached tasks
-                cache_tasks = Cache().get('tasks')  # type: dict
+                cache_tasks = Cache().get('tasks', retry=True, metrics_tag='scheduler')  # type: dict
                 task = cache_tasks.pop(stop_item, None)
                 if task:
-                    Cache().set('tasks', cache_tasks, tag='scheduler')
+                    Cache().set('tasks', cache_tasks, tag='scheduler', retry=True)
 
     def handle_rsp_shell(self, value):
         """Launch the Remote shell websocket listener"""
@@ -357,13 +376,14 @@ class Scheduler(metaclass=ABCMeta):
 
     def fetch(self) -> Tuple[dict, dict]:
         """Get tasks to activate and stop from the server (if available)"""
-        status_report = {k: v.status_report() for k, v in self.tasks.items()}
+        last_runs = self._get_last_runs(self.tasks.values())
+        status_report = {k: v.status_report(last_runs) for k, v in self.tasks.items()}
         try:
             req = req_sess.post('task', json=status_report)
             rsp = req.json() if req.status_code == 200 else {}
         except CommException as comm_exc:
             logging.warning("Could not poll tasks from server : %s", comm_exc)
-            cache_tasks = Cache().get('tasks')  # type: dict
+            cache_tasks = Cache().get('tasks', metrics_tag='scheduler')  # type: dict
             self.__create_tasks(cache_tasks)
             return self.tasks, dict()
 
@@ -382,6 +402,11 @@ class Scheduler(metaclass=ABCMeta):
 
         return self.tasks, self.stopped_tasks
 
+    @staticmethod
+    def _get_last_runs(tasks) -> dict:
+        """Read the last runs of several tasks at once"""
+        return Cache().get_many([x for task in tasks for x in task.last_run_keys()], metrics_tag='scheduler')
+
     def _stop_tasks(self, tasks):
         for _ in range(Config().STOP_TRIES):
             run_count = 0
@@ -397,6 +422,10 @@ class Scheduler(metaclass=ABCMeta):
     def _launch_tasks(self) -> list:
         logging.debug("Scheduler running")
 
+        # Cache counters, to size the expirations and the disk limits
+        if Cache().metrics.log_due(Config().get('CACHE_METRICS_LOG_INTERVAL', 3600)):
+            Cache().log_report()
+
         for item in self.to_notify:
             notifier = getattr(item, 'notify', None)
             if callable(notifier):
@@ -410,8 +439,9 @@ class Scheduler(metaclass=ABCMeta):
             logging.error("Could not stop tasks")
 
         # Second step: launch the tasks
+        last_runs = self._get_last_runs(active_tasks.values())
         for task in active_tasks.values():
-            task_config = task.get_active_config()
+            task_config = task.get_active_config(last_runs)
             if task_config:
                 tmp = task.run(task_config)
                 if tmp:
@@ -22,10 +22,7 @@ import json
 import base64
 from typing import Optional
 
-from Crypto.Signature import PKCS1_PSS
-from Crypto.Hash import SHA512
-from Crypto.PublicKey import RSA
-
+from epc.common.crypto import verify_signature
 from epc.common.utils import Singleton
 
 
@@ -78,11 +75,7 @@ class Config(metaclass=Singleton):
 
     def __verify_signature(self, signature: bytes, data: bytes) -> bool:
         """Check the config signature"""
-        key = RSA.importKey(self.pub_key)
-        hashalgo = SHA512.new()
-        hashalgo.update(data)
-        verifier = PKCS1_PSS.new(key)
-        return verifier.verify(hashalgo, signature)
+        return verify_signature(self.pub_key, [data], signature)
 
     def reload(self):
         """Reload the configuration"""
@@ -18,6 +18,8 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 """
+import threading
+from contextlib import contextmanager
 
 
 class Singleton(type):
@@ -28,3 +30,48 @@ class Singleton(type):
         if cls not in cls._instances:
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
+
+
+class KeyedLock(object):
+    """Reentrant locks by key, created on demand and dropped once no thread holds or waits for them"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__locks = dict()  # key -> [RLock, holders and waiters]
+
+    def acquire(self, key, blocking: bool = True) -> bool:
+        """Acquire the lock of a key, returns False when it is held by another thread and blocking is False"""
+        with self.__lock:
+            entry = self.__locks.get(key)
+            if entry is None:
+                entry = self.__locks[key] = [threading.RLock(), 0]
+            entry[1] += 1
+        if entry[0].acquire(blocking):
+            return True
+        self.__unref(key)
+        return False
+
+    def release(self, key) -> None:
+        """Release the lock of a key"""
+        self.__locks[key][0].release()
+        self.__unref(key)
+
+    def __unref(self, key) -> None:
+        with self.__lock:
+            entry = self.__locks[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.__locks[key]
+
+    @contextmanager
+    def hold(self, key):
+        """Hold the lock of a key for the duration of the context"""
+        self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__locks)
@@ -21,6 +21,7 @@ along with EPControl.  If not, see <http://www.gnu.org/licenses/>.
 import logging
 import multiprocessing
 import multiprocessing.connection
+import queue
 import time
 from multiprocessing import Process
 from threading import Thread
@@ -29,8 +30,43 @@ import epc.common.scheduler
 import epc.common.sentry
 import epc.pc.worker as worker
 import psutil
+from epc.common.codearena import SharedCodeArena
 from epc.common.comm import req_sess
+from epc.common.importer import EPCLoader
 from epc.common.settings import Config
+from epc.common.utils import Singleton
+
+
+class CodePublisher(metaclass=Singleton):
+    """
+    Publish the code recorded for the apps in the shared code arena, so that their workers map it
+    instead of each loading, verifying and decrypting it. Workers started before it is published
+    load their code as usual.
+    """
+
+    def __init__(self):
+        self.__queue = queue.Queue()
+        self.__thread = None
+
+    def publish(self, app: str) -> None:
+        """Publish the code of an app in the background"""
+        if not SharedCodeArena().enabled:
+            return
+        if self.__thread is None:
+            self.__thread = Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+        self.__queue.put(app)
+
+    def __run(self):
+        loader = EPCLoader()  # Blocks until a manifest is available
+        while True:
+            app = self.__queue.get()
+            try:
+                count = loader.publish_app(app)
+                if count:
+                    logging.info("Published %d modules of %s", count, app)
+            except Exception:
+                logging.exception("Error while publishing the code of %s", app)
 
 
 class Task(epc.common.scheduler.Task):
@@ -51,6 +87,7 @@ class Task(epc.common.scheduler.Task):
         self.data['kwargs']['config'] = config
 
         logging.info("Launching task {} | {}".format(self.data['module'], config))
+        CodePublisher().publish(self.data['module'])
         self.app_handle = multiprocessing.Process(
             target=worker.run,
             name=self.data['app'],
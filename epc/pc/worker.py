@@ -25,8 +25,10 @@ from threading import Thread
 
 import epc.common.settings as settings
 from epc.common.auth import EPCAuth
+from epc.common.cache import Cache
 from epc.common.comm import req_sess
-from epc.common.importer import setup_importer
+from epc.common.importer import get_loader, setup_importer
+from epc.common.importprofile import get_profile_dir, get_profiler
 from epc.common.sentry import client
 
 
@@ -56,8 +58,31 @@ class Worker(object):
         self.kwargs = kwargs
         self.app = None
 
+    def __prefetch(self):
+        """Prefetch the modules imported by the previous run and record the current one"""
+        loader = get_loader()
+        if not loader:
+            return None
+        try:
+            loader.prefetch(loader.get_trace(self.data['module']))
+        except Exception:
+            logging.exception("Error while prefetching app modules")
+        loader.start_trace(self.data['module'])
+        return loader
+
+    def __export_profile(self):
+        """Write the import profile of the app, when IMPORTER_PROFILE is set"""
+        profiler = get_profiler()
+        if not profiler:
+            return
+        extra = dict(transfer=req_sess.transfer_stats(), cache=Cache().report())
+        filename = profiler.export(get_profile_dir(), self.data['module'], extra)
+        if filename:
+            logging.info("Import profile written to %s", filename)
+
     def run(self) -> int:
         """Run the worker"""
+        loader = self.__prefetch()
         try:
             module = importlib.import_module('apps.{}'.format(self.data['module']))
         except ImportError:
@@ -92,6 +117,9 @@ class Worker(object):
         finally:
             self.__stop_events[0].set()
             stop_thread.join()
+            if loader:
+                loader.stop_trace()
+            self.__export_profile()
             return ret
 
     def __stop_worker(self):
@@ -141,6 +141,7 @@ setup(
     extras_require={
         'dev': [],
         'test': [],
+        'openssl': ['cryptography'],
     },
 
     # If there are data files included in your packages that need to be